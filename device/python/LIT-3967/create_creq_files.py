@@ -5,7 +5,7 @@ import logging
 from multiprocessing.pool import ThreadPool
 import math
 
-from ratelimit import Ratelimit
+from ratelimit import TokenBucket
 
 
 logger = logging.getLogger(__name__)
@@ -95,7 +95,7 @@ def main():
     argparser.add_argument("--threads", type=int, default=48)
 
     args = argparser.parse_args()
-    ratelimit = Ratelimit(0.01)
+    ratelimit = TokenBucket(100, burst=10)
     s3_client = boto3.client("s3")
 
     with ThreadPool(processes=args.threads, initializer=_run_init,
@@ -0,0 +1,83 @@
+"""Fake boson hosts backed by the ssh/scp shims in `bench/shim`."""
+
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Iterable
+
+
+logger = logging.getLogger(__name__)
+
+
+SHIM_DIR = Path(__file__).resolve().parent / "shim"
+
+
+class FakeBoson:
+    """Environment that routes frpc boson calls to local shims.
+
+    While active, `ssh`, `scp`, `sshpass` and `boson` resolve to the shims,
+    boson hosts live in a temporary directory and every registered device
+    has a CSTAT file there, so `boson_base.sh` runs unmodified.
+    """
+
+    def __init__(self, boson_latency: float = 0.05,
+                 device_latency: float = 0.5, failure_rate: float = 0.):
+        """Class constructor.
+
+        Arguments:
+            boson_latency: latency in seconds of every ssh/scp call to a boson
+                           host.
+            device_latency: mean latency in seconds of a device command,
+                            uniformly jittered by +-50%.
+            failure_rate: probability of a device command failure.
+        """
+        self.boson_latency = boson_latency
+        self.device_latency = device_latency
+        self.failure_rate = failure_rate
+        self.root = None
+
+        self.__environ = None
+
+    def __enter__(self):
+        """Context manager entrance point."""
+        self.start()
+
+        return self
+
+    def __exit__(self, *_):
+        """Context manager exit point."""
+        self.stop()
+
+    def start(self):
+        """Create boson hosts root and patch `os.environ`."""
+        self.root = Path(tempfile.mkdtemp(prefix="frpc-bench-"))
+        self.__environ = dict(os.environ)
+
+        os.environ.update({
+            "PATH": f"{SHIM_DIR}{os.pathsep}{os.environ['PATH']}",
+            "CSTAT_DIR": str(self.root / "cstat"),
+            "FAKE_BOSON_ROOT": str(self.root),
+            "FAKE_BOSON_LATENCY": str(self.boson_latency),
+            "FAKE_DEVICE_LATENCY": str(self.device_latency),
+            "FAKE_DEVICE_FAILURE_THRESHOLD":
+                str(int(self.failure_rate * 32768)),
+            })
+
+        logger.debug(f"fake boson root is `{self.root}`")
+
+    def stop(self):
+        """Restore `os.environ` and remove boson hosts root."""
+        os.environ.clear()
+        os.environ.update(self.__environ)
+
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def add_devices(self, macs: Iterable[str]):
+        """Make `macs` reachable over boson."""
+        for mac in macs:
+            cstat = self.root / "cstat" / mac[-2:] / mac
+
+            cstat.parent.mkdir(parents=True, exist_ok=True)
+            cstat.touch()
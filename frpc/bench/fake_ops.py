@@ -0,0 +1,155 @@
+"""Fake OPS portal serving `authenticate` and `deviceRPC` requests."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+REST_PREFIX = "/bam/rest/sn/v1/"
+
+
+class FakeOPS:
+    """Local HTTP server that mimics the OPS REST API used by frpc.
+
+    Every `deviceRPC` request takes about `latency` seconds, fails with
+    a 503 with probability `failure_rate` and with a 401 once the access
+    token is older than `token_ttl` seconds.
+    """
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.,
+                 token_ttl: float = None):
+        """Class constructor.
+
+        Arguments:
+            latency: mean `deviceRPC` latency in seconds, uniformly jittered
+                     by +-50%.
+            failure_rate: probability of a transient `deviceRPC` failure.
+            token_ttl: access token lifetime in seconds, unlimited if None.
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.token_ttl = token_ttl
+        self.requests = 0
+
+        self.__lock = threading.Lock()
+        self.__tokens: Dict[str, float] = {}
+        self.__counter = itertools.count()
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL to use in place of an OPS endpoint."""
+        host, port = self.__server.server_address
+
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        """Start serving on a random local port."""
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                            self.__mkhandler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         daemon=True, name="fake-ops")
+        self.__thread.start()
+
+        logger.debug(f"fake OPS is listening on {self.url}")
+
+    def stop(self):
+        """Stop the server."""
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def __enter__(self):
+        """Context manager entrance point."""
+        self.start()
+
+        return self
+
+    def __exit__(self, *_):
+        """Context manager exit point."""
+        self.stop()
+
+    def authenticate(self) -> str:
+        """Issue a new access token."""
+        token = f"fake-token-{next(self.__counter)}"
+
+        with self.__lock:
+            self.__tokens[token] = time.monotonic()
+
+        return token
+
+    def device_rpc(self, token: str) -> int:
+        """Simulate a `deviceRPC` call, return the HTTP status."""
+        with self.__lock:
+            self.requests += 1
+            issued = self.__tokens.get(token)
+
+        if issued is None:
+            return 401
+
+        if self.token_ttl is not None and \
+                time.monotonic() - issued > self.token_ttl:
+            return 401
+
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if random.random() < self.failure_rate:
+            return 503
+
+        return 200
+
+    def __mkhandler(self):
+        ops = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_):
+                pass
+
+            def do_PUT(self):
+                self.__read_body()
+
+                if self.path.startswith(REST_PREFIX + "authenticate"):
+                    self.__reply(200, {"access_token": ops.authenticate()})
+                else:
+                    self.__reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                self.__read_body()
+
+                if not self.path.startswith(REST_PREFIX + "deviceRPC"):
+                    self.__reply(404, {"error": "not found"})
+
+                    return
+
+                token = self.path.partition("access_token=")[2]
+                status = ops.device_rpc(token.partition("&")[0])
+
+                self.__reply(status, {"status": status})
+
+            def __read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+
+                return self.rfile.read(length)
+
+            def __reply(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
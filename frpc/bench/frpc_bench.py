@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Offline frpc throughput benchmark.
+
+Drives ParallelExecutor (or AsyncExecutor) with BosonInterface against fake
+boson hosts and RPCInterface against a fake OPS portal, for every
+combination of device count, executor count and partition size, and
+reports devices per second and tail latencies. See bench/README.md.
+"""
+
+from argparse import ArgumentParser
+import itertools
+import json
+import logging
+from pathlib import Path
+import sys
+import time
+from typing import List, NamedTuple
+
+from frpc import argparse_type
+from frpc.boson_interface import BosonInterfaceFactory
+from frpc.executor import AsyncExecutor, ParallelExecutor
+from frpc import metrics
+from frpc import rpc_interface
+from frpc.script_executor import ScriptExecutor
+
+from fake_boson import FakeBoson
+from fake_ops import FakeOPS
+
+
+logger = logging.getLogger("frpc_bench")
+
+
+BENCH_ENV = "bench"
+BOSON_FIRST = 1
+
+
+class BenchCase(NamedTuple):
+    """Single point of the benchmark matrix."""
+
+    interface: str
+    engine: str
+    devices: int
+    processes: int
+    batch_size: int
+
+
+class BenchResult(NamedTuple):
+    """Benchmark measurements of a `BenchCase`."""
+
+    case: BenchCase
+    elapsed: float
+    devices_per_sec: float
+    success_rate: float
+    partition_p50: float
+    partition_p99: float
+    device_p50: float
+    device_p99: float
+
+
+def mkmacs(count: int) -> List[str]:
+    """Generate `count` unique fake MACs."""
+    return [f"fbe{i:09x}" for i in range(count)]
+
+
+def run_case(case: BenchCase, interface_factory, script: str,
+             chunk_time: float) -> BenchResult:
+    """Run a single benchmark case."""
+    macs = mkmacs(case.devices)
+    kwargs = {
+            "interface_factory": interface_factory,
+            "executor": ScriptExecutor([script]),
+            "batch_size": case.batch_size,
+            "chunk_time": chunk_time,
+            }
+
+    if case.engine == "async":
+        executor = AsyncExecutor(macs, inflight=case.processes, **kwargs)
+    else:
+        executor = ParallelExecutor(macs, processes=case.processes,
+                                    **kwargs)
+
+    metrics.METRICS.reset()
+
+    start = time.monotonic()
+    results = executor.run()
+    elapsed = time.monotonic() - start
+
+    summary = metrics.METRICS.to_json()
+    partition = summary.get("partition", {})
+    # RPC measures real per-device time, boson only the partition average
+    device = summary.get("rpc_device", summary.get("device", {}))
+    succeeded = sum(result.success for result in results)
+
+    return BenchResult(
+            case=case,
+            elapsed=elapsed,
+            devices_per_sec=case.devices / elapsed,
+            success_rate=succeeded / max(len(results), 1),
+            partition_p50=partition.get("p50"),
+            partition_p99=partition.get("p99"),
+            device_p50=device.get("p50"),
+            device_p99=device.get("p99"))
+
+
+def format_result(result: BenchResult) -> str:
+    """Format a result as a table row."""
+    case = result.case
+
+    return f"{case.interface:>6} {case.engine:>6} {case.devices:>7} \
+{case.processes:>5} {str(case.batch_size):>6} {result.elapsed:>8.2f} \
+{result.devices_per_sec:>9.1f} {result.success_rate * 100:>6.1f}% \
+{result.partition_p50:>8.3f} {result.partition_p99:>8.3f} \
+{result.device_p50:>8.3f} {result.device_p99:>8.3f}"
+
+
+HEADER = f"{'iface':>6} {'engine':>6} {'devices':>7} {'procs':>5} \
+{'batch':>6} {'time, s':>8} {'devices/s':>9} {'ok':>7} {'part p50':>8} \
+{'part p99':>8} {'dev p50':>8} {'dev p99':>8}"
+
+
+def create_argparser() -> ArgumentParser:
+    """Create benchmark command-line parser."""
+    argparser = ArgumentParser(description=__doc__.splitlines()[0])
+
+    argparser.add_argument("--interface", nargs="+", choices=["boson", "rpc"],
+                           default=["boson", "rpc"],
+                           help="interfaces to benchmark")
+
+    argparser.add_argument("--engine", nargs="+", choices=["thread", "async"],
+                           default=["thread"],
+                           help="execution engines to benchmark")
+
+    argparser.add_argument("--devices", nargs="+",
+                           type=argparse_type.irange(1),
+                           default=[100, 1000],
+                           help="device counts to benchmark")
+
+    argparser.add_argument("--processes", nargs="+",
+                           type=argparse_type.irange(1),
+                           default=[4, 16],
+                           help="--exec-processes values to benchmark")
+
+    argparser.add_argument("--batch-sizes", nargs="+",
+                           type=argparse_type.irange(1),
+                           default=[50, 200],
+                           help="--exec-partition-size values to benchmark")
+
+    argparser.add_argument("--chunk-time", type=argparse_type.frange(0),
+                           default=60.,
+                           help="--exec-chunk-time value")
+
+    argparser.add_argument("--boson-hosts", type=argparse_type.irange(1),
+                           default=4,
+                           help="number of fake boson hosts")
+
+    argparser.add_argument("--boson-latency", type=argparse_type.frange(0),
+                           default=0.05,
+                           help="latency of a single boson ssh call, seconds")
+
+    argparser.add_argument("--remote-parallelism",
+                           type=argparse_type.irange(1, 64), default=8,
+                           help="devices processed concurrently per partition \
+on a fake boson host")
+
+    argparser.add_argument("--device-latency", type=argparse_type.frange(0),
+                           default=0.2,
+                           help="mean device command latency, seconds")
+
+    argparser.add_argument("--ops-latency", type=argparse_type.frange(0),
+                           default=0.05,
+                           help="mean fake OPS deviceRPC latency, seconds")
+
+    argparser.add_argument("--rpc-inflight", type=argparse_type.irange(1),
+                           default=8,
+                           help="concurrent OPS requests per partition")
+
+    argparser.add_argument("--failure-rate",
+                           type=argparse_type.frange(0, 1), default=0.,
+                           help="probability of a device or OPS failure")
+
+    argparser.add_argument("--json", type=Path,
+                           help="also write results into a JSON file")
+
+    argparser.add_argument("-v", "--verbose", action="store_true",
+                           help="show frpc log messages")
+
+    return argparser
+
+
+def main():
+    """Benchmark entry point."""
+    args = create_argparser().parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.WARNING)
+
+    cases = [
+            BenchCase(*values)
+            for values in itertools.product(
+                args.interface, args.engine, args.devices, args.processes,
+                args.batch_sizes)
+            ]
+
+    max_devices = max(args.devices)
+    results = []
+
+    with FakeBoson(boson_latency=args.boson_latency,
+                   device_latency=args.device_latency,
+                   failure_rate=args.failure_rate) as boson, \
+            FakeOPS(latency=args.ops_latency,
+                    failure_rate=args.failure_rate) as ops:
+        boson.add_devices(mkmacs(max_devices))
+        rpc_interface.OPS_ENDPOINTS[BENCH_ENV] = ops.url
+
+        factories = {
+                "boson": BosonInterfaceFactory(
+                    boson_index=(BOSON_FIRST,
+                                 BOSON_FIRST + args.boson_hosts - 1),
+                    remote_parallelism=args.remote_parallelism),
+                "rpc": rpc_interface.RPCInterfaceFactory(
+                    rpc_interface.OPSCredentials(BENCH_ENV, "bench", "bench"),
+                    inflight=args.rpc_inflight,
+                    retry=rpc_interface.RetryPolicy(backoff=0.05)),
+                }
+
+        print(HEADER)
+
+        for case in cases:
+            result = run_case(case, factories[case.interface],
+                              "echo benchmark", args.chunk_time)
+            results.append(result)
+
+            print(format_result(result), flush=True)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps([
+            dict(result._asdict(), case=result.case._asdict())
+            for result in results
+            ], indent=4) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
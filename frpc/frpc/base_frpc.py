@@ -3,7 +3,6 @@
 
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser, Namespace
-import csv
 from enum import Enum, unique
 from functools import partial
 import logging
@@ -15,11 +14,19 @@ import time
 from botocore.exceptions import ClientError
 
 from . import argparse_type
-from .boson_interface import BosonInterface, BosonInterfaceFactory
-from .executor import RemoteExecutor, ParallelExecutor, ExecutionResult
+from .boson_interface import BosonInterface, BosonInterfaceFactory, \
+        BosonPool
+from .executor import RemoteExecutor, ParallelExecutor, AsyncExecutor, \
+        ExecutionResult
 from .interface import InterfaceFactory
+from .macset import MacSet
+from . import metrics
+from .ratelimit import KeyedRatelimit
+from .result_sink import ResultSink, SINK_FORMATS, collect_results, \
+        create_sink
 from . import targeting
 from . import rpc_interface
+from .tar_codec import CODEC_CHOICES, CODECS
 
 
 logger = logging.getLogger(__name__)
@@ -37,6 +44,30 @@ class Interfaces(Enum):
         return str(self.value)
 
 
+@unique
+class ExecEngines(Enum):
+    """List of available execution engines."""
+
+    THREAD = "thread"
+    ASYNC = "async"
+
+    def __str__(self):
+        """Translate enum into readable string for argparse."""
+        return str(self.value)
+
+
+@unique
+class ResultTransfers(Enum):
+    """List of available boson result transfer methods."""
+
+    STREAM = "stream"
+    SCP = "scp"
+
+    def __str__(self):
+        """Translate enum into readable string for argparse."""
+        return str(self.value)
+
+
 class FRPCFormatter(logging.Formatter):
     """FRPC colored logging formatter."""
 
@@ -101,9 +132,8 @@ class BaseFRPC(ABC):
         """
         self.__targeting_handlers = {
                 "no_boson": self.__get_no_boson_macs,
-                "no_boson_m2": partial(
-                    self.__get_no_boson_macs,
-                    dr_filter=lambda x: x.startswith("64dba0f"))
+                "no_boson_m2": partial(self.__get_no_boson_macs,
+                                       dr_prefix="64dba0f")
                 }
 
         if default_argparser:
@@ -118,7 +148,11 @@ class BaseFRPC(ABC):
                                     help="bypass the limit on {} devices"
                                          .format(self.DEVICES_LIMIT))
 
+        self._argparser_add_metrics()
+
         self.__setup_logging()
+        self.__boson_pool = None
+        self.__metrics_dump = None
 
         self.factories = {
                 Interfaces.BOSON: self.create_boson_factory,
@@ -132,6 +166,15 @@ class BaseFRPC(ABC):
         if self.args.verbose:
             self.__stream_handler.setLevel(logging.DEBUG)
 
+        if self.args.metrics_period is not None:
+            if self.args.metrics_output is None:
+                logger.critical("--metrics-period requires --metrics-output")
+
+            self.__metrics_dump = metrics.PeriodicDump(
+                    metrics.METRICS, self.args.metrics_output,
+                    self.args.metrics_period, self.args.metrics_format)
+            self.__metrics_dump.start()
+
         self.macs = self.__process_targeting() \
             if hasattr(self.args, "targeting") else None
 
@@ -143,6 +186,23 @@ class BaseFRPC(ABC):
         """Main program codepath."""
         raise NotImplementedError("Implement program codepath here")
 
+    def dump_metrics(self):
+        """Stop periodic dumps and write final `--metrics-output`."""
+        if self.__metrics_dump is not None:
+            self.__metrics_dump.stop()
+            self.__metrics_dump = None
+
+        if self.args.metrics_output is None:
+            return
+
+        try:
+            metrics.METRICS.dump(self.args.metrics_output,
+                                 self.args.metrics_format)
+        except OSError as err:
+            logger.error(f"failed to dump metrics: {err}")
+        else:
+            logger.info(f"metrics written to `{self.args.metrics_output}`")
+
     def create_boson_factory(self):
         """Create boson interface factory from `self.args`."""
         if self.args.boson_index is not None:
@@ -162,7 +222,57 @@ expected --boson-range to have two increasing values")
         else:
             boson_index = None
 
-        return BosonInterfaceFactory(boson_index=boson_index)
+        codec = CODECS.get(self.args.boson_codec)
+        level = self.args.boson_codec_level
+
+        # "auto" fits the level into whichever codec it picks
+        if level is not None and codec is not None:
+            if codec.levels is None:
+                logger.critical(f"--boson-codec {codec.name} doesn't support \
+--boson-codec-level")
+            elif not codec.levels[0] <= level <= codec.levels[1]:
+                logger.critical(f"--boson-codec {codec.name} expects \
+--boson-codec-level in [{codec.levels[0]};{codec.levels[1]}]")
+
+        kwargs = {
+                "multiplex": not self.args.boson_no_multiplex,
+                "stream_results": self.args.boson_result_transfer
+                is ResultTransfers.STREAM,
+                "remote_parallelism": self.args.remote_parallelism,
+                "codec": self.args.boson_codec,
+                "codec_level": self.args.boson_codec_level,
+                }
+
+        if self.args.boson_pool:
+            if self.args.boson_index is not None:
+                logger.critical("\
+--boson-pool cannot be used with --boson-index")
+
+            kwargs["boson_pool"] = self.create_boson_pool(boson_index,
+                                                          **kwargs)
+
+        return BosonInterfaceFactory(boson_index=boson_index, **kwargs)
+
+    def create_boson_pool(self, boson_range=None, **kwargs) -> BosonPool:
+        """Create a boson pool from `self.args`, probe it if requested.
+
+        The pool is created once and shared by all boson factories.
+
+        Arguments:
+            boson_range: first and last boson index, all servers if None.
+            kwargs: `BosonInterface` keyword arguments for probing.
+        """
+        if self.__boson_pool is None:
+            first, last = (None, None) if boson_range is None \
+                else boson_range
+
+            self.__boson_pool = BosonPool(
+                    first, last, max_inflight=self.args.boson_pool_cap)
+
+            if self.args.boson_probe:
+                self.__boson_pool.probe(**kwargs)
+
+        return self.__boson_pool
 
     def create_rpc_factory(self):
         """Create RPC factory from `self.args`."""
@@ -173,7 +283,28 @@ expected --boson-range to have two increasing values")
             logger.exception("failed to load credentials")
             logger.critical("can't continue without credentials")
 
-        return rpc_interface.RPCInterfaceFactory(rpc_creds)
+        ratelimit = None
+
+        if self.args.rpc_rate is not None:
+            ratelimit = KeyedRatelimit(self.args.rpc_rate,
+                                       burst=max(self.args.rpc_rate, 1))
+
+        retry = rpc_interface.RetryPolicy(
+                retries=self.args.rpc_retries,
+                backoff=self.args.rpc_backoff)
+
+        return rpc_interface.RPCInterfaceFactory(
+                rpc_creds, ratelimit=ratelimit,
+                inflight=self.args.rpc_inflight, retry=retry)
+
+    def create_sumo_cache(self):
+        """Create SUMO query results cache from `self.args`."""
+        if self.args.sumo_no_cache:
+            return None
+
+        return targeting.SumoCache(
+                ttl=self.args.sumo_cache_ttl,
+                granularity=self.args.sumo_cache_granularity)
 
     def create_interface_factory(self):
         """Create interface factory from `self.args`."""
@@ -185,7 +316,11 @@ expected --boson-range to have two increasing values")
         try:
             frpc = cls()
             frpc.load()
-            frpc.exec()
+
+            try:
+                frpc.exec()
+            finally:
+                frpc.dump_metrics()
         except KeyboardInterrupt:
             logger.warning("got interrupt")
             sys.exit(130)
@@ -210,7 +345,7 @@ a local sumoql file, an embedded sumoql file ({sumoql_files}), \
         self.argparser.add_argument("--truncate",
                                     action="store_true",
                                     help="reduce targets amount \
-to fit into devices limit")
+to fit into devices limit, keeping the numerically lowest MACs")
 
         self.argparser.add_argument("--sumo-time-offset",
                                     type=argparse_type.irange(start=0),
@@ -227,6 +362,48 @@ positive value in seconds, minimum 300")
                                     help="query start and end time, \
 in UNIX timestamp")
 
+        cache_dir = targeting.DEVICE_REGISTRY_CACHE_DIR
+
+        self.argparser.add_argument("--device-registry-cache", type=Path,
+                                    default=cache_dir,
+                                    help="directory to cache S3 device \
+registries in")
+
+        self.argparser.add_argument("--device-registry-no-cache",
+                                    action="store_true",
+                                    help="always download the device \
+registry from S3")
+
+        self.argparser.add_argument("--device-registry-max-age",
+                                    type=argparse_type.irange(start=0),
+                                    default=targeting.DEVICE_REGISTRY_MAX_AGE,
+                                    help="seconds a cached device registry \
+stays fresh after it was validated against S3")
+
+        self.argparser.add_argument("--device-registry-offline",
+                                    action="store_true",
+                                    help="don't access S3 if there is a fresh \
+cached device registry")
+
+        self._argparser_add_sumo()
+
+    def _argparser_add_sumo(self):
+        self.argparser.add_argument("--sumo-no-cache", action="store_true",
+                                    help="always run SUMO queries instead of \
+reusing cached results")
+
+        self.argparser.add_argument("--sumo-cache-ttl",
+                                    type=argparse_type.irange(start=0),
+                                    default=targeting.SUMO_CACHE_TTL,
+                                    help="seconds cached SUMO query results \
+stay valid")
+
+        self.argparser.add_argument("--sumo-cache-granularity",
+                                    type=argparse_type.irange(start=0),
+                                    default=targeting.SUMO_CACHE_GRANULARITY,
+                                    help="seconds SUMO query time ranges are \
+rounded to when looking up cached results")
+
     def _argparser_add_interface(self):
         self.argparser.add_argument("--interface", type=Interfaces,
                                     choices=list(Interfaces),
@@ -247,6 +424,54 @@ in UNIX timestamp")
                                     help="randomly generate boson index from \
 the specified range for every mac")
 
+        self.argparser.add_argument("--boson-pool", action="store_true",
+                                    help="\
+pick boson servers from --boson-range (or all servers) by measured connect \
+latency and failure rate instead of round-robin")
+
+        self.argparser.add_argument("--boson-pool-cap",
+                                    type=argparse_type.irange(start=1),
+                                    default=4,
+                                    help="\
+maximum number of partitions running on one boson server with --boson-pool")
+
+        self.argparser.add_argument("--boson-probe", action="store_true",
+                                    help="\
+measure connect latency of every boson server before using --boson-pool")
+
+        self.argparser.add_argument("--boson-no-multiplex",
+                                    action="store_true",
+                                    help="\
+open a new ssh connection for every boson call instead of reusing \
+one persistent connection per boson server")
+
+        self.argparser.add_argument("--boson-result-transfer",
+                                    type=ResultTransfers,
+                                    choices=list(ResultTransfers),
+                                    default=ResultTransfers.STREAM,
+                                    help="\
+receive results on stdout of the execution ssh session (stream) or store \
+them on boson and fetch them with scp, for unreliable stdout channels")
+
+        self.argparser.add_argument("--remote-parallelism",
+                                    type=argparse_type.irange(1, 64),
+                                    default=1,
+                                    help="\
+number of devices every boson server processes concurrently")
+
+        self.argparser.add_argument("--boson-codec", choices=CODEC_CHOICES,
+                                    default="auto",
+                                    help="\
+compression of the archive sent to boson. auto sends small archives \
+uncompressed and large ones with zstd or lz4 if both sides support them, \
+otherwise gzip")
+
+        self.argparser.add_argument("--boson-codec-level",
+                                    type=argparse_type.irange(0, 22),
+                                    help="\
+--boson-codec compression level: 0-9 for gzip, 0-16 for lz4, 1-22 for zstd. \
+auto fits it into the range of the codec it picks. Codec default by default")
+
     def _argparser_add_rpc(self):
         self.argparser.add_argument("--rpc-creds", type=str, help="OPS portal \
 credentials file in JSON format")
@@ -255,6 +480,49 @@ credentials file in JSON format")
                                     choices=rpc_interface.ENVIRONMENTS,
                                     help="Cloud envoronment to use")
 
+        self.argparser.add_argument("--rpc-rate",
+                                    type=argparse_type.frange(
+                                        0, start_inc=False),
+                                    help="\
+maximum number of OPS requests per second, unlimited by default")
+
+        self.argparser.add_argument("--rpc-inflight",
+                                    type=argparse_type.irange(1, 256),
+                                    default=8,
+                                    help="\
+maximum number of concurrent OPS requests per partition")
+
+        self.argparser.add_argument("--rpc-retries",
+                                    type=argparse_type.irange(0, 16),
+                                    default=3,
+                                    help="\
+number of retries of a transient OPS failure (connection error, 5xx, 429)")
+
+        self.argparser.add_argument("--rpc-backoff",
+                                    type=argparse_type.frange(
+                                        0, start_inc=False),
+                                    default=0.5,
+                                    help="\
+base delay in seconds of the exponential backoff between OPS retries")
+
+    def _argparser_add_metrics(self):
+        self.argparser.add_argument("--metrics-output", type=Path,
+                                    help="\
+write per-phase timing histograms into a file at exit, e.g. into the \
+node exporter textfile collector directory")
+
+        self.argparser.add_argument("--metrics-format",
+                                    choices=metrics.METRICS_FORMATS,
+                                    help="\
+--metrics-output file format, JSON for a .json file and Prometheus \
+text format otherwise by default")
+
+        self.argparser.add_argument("--metrics-period",
+                                    type=argparse_type.frange(
+                                        0, start_inc=False),
+                                    help="\
+also dump --metrics-output every METRICS_PERIOD seconds while running")
+
     def _argparser_add_exec(self):
         self.argparser.add_argument("--exec-processes",
                                     type=BosonInterface.validate_index,
@@ -263,7 +531,46 @@ number of executors to run in parallel")
 
         self.argparser.add_argument("--exec-output",
                                     type=Path,
-                                    help="write execution results to a .csv")
+                                    help="\
+stream execution results into a .csv or .jsonl file")
+
+        self.argparser.add_argument("--exec-output-format",
+                                    choices=list(SINK_FORMATS),
+                                    help="\
+--exec-output file format, guessed from the file extension by default")
+
+        self.argparser.add_argument("--exec-engine", type=ExecEngines,
+                                    choices=list(ExecEngines),
+                                    default=ExecEngines.THREAD,
+                                    help="\
+run partitions on a thread pool or on a single asyncio event loop")
+
+        self.argparser.add_argument("--exec-inflight",
+                                    type=argparse_type.irange(start=1),
+                                    default=64,
+                                    help="\
+maximum number of partitions in flight for the async engine")
+
+        self.argparser.add_argument("--exec-partition-size",
+                                    type=argparse_type.irange(start=1),
+                                    help="\
+maximum number of devices per partition, partitions are handed out to \
+free executors and shrink towards the end of the run")
+
+        self.argparser.add_argument("--exec-min-partition-size",
+                                    type=argparse_type.irange(start=1),
+                                    help="\
+minimum number of devices per partition, so tail partitions don't pay \
+a full interface open for a handful of devices. Defaults to 8 for boson \
+and 4 for rpc, capped by --exec-partition-size")
+
+        self.argparser.add_argument("--exec-chunk-time",
+                                    type=argparse_type.frange(
+                                        0, start_inc=False),
+                                    default=60.,
+                                    help="\
+desired time in seconds to process a partition, partition size is adapted \
+to the observed per-device latency")
 
     def _exec(self, executor: RemoteExecutor,
               output_suffix: str = None) -> List[ExecutionResult]:
@@ -275,47 +582,66 @@ number of executors to run in parallel")
 
         Arguments:
             executor: a callable that accepts an `Interface`.
-        """
-        if self.args.exec_processes is not None:
-            executor = ParallelExecutor(
-                    self.macs,
-                    interface_factory=self.interface_factory,
-                    executor=executor,
-                    processes=self.args.exec_processes)
-
-            results = executor.run()
-        else:
-            with self.interface_factory(self.macs) as interface:
-                results = executor(interface)
+            output_suffix: suffix inserted into the `--exec-output` filename.
 
-        logger.debug(results)
+        Results are streamed into `--exec-output` as partitions complete,
+        in that case the returned results carry no stdout/stderr.
+        """
+        sink = self._create_sink(output_suffix)
 
-        if self.args.exec_output is not None and results:
-            path = self.args.exec_output
+        try:
+            if self.args.exec_engine is ExecEngines.ASYNC:
+                executor = AsyncExecutor(
+                        self.macs,
+                        interface_factory=self.interface_factory,
+                        executor=executor,
+                        inflight=self.args.exec_inflight,
+                        batch_size=self.args.exec_partition_size,
+                        min_batch_size=self.args.exec_min_partition_size,
+                        chunk_time=self.args.exec_chunk_time)
+
+                results = executor.run(sink=sink)
+            elif self.args.exec_processes is not None:
+                executor = ParallelExecutor(
+                        self.macs,
+                        interface_factory=self.interface_factory,
+                        executor=executor,
+                        processes=self.args.exec_processes,
+                        batch_size=self.args.exec_partition_size,
+                        min_batch_size=self.args.exec_min_partition_size,
+                        chunk_time=self.args.exec_chunk_time)
+
+                results = executor.run(sink=sink)
+            else:
+                with self.interface_factory(self.macs) as interface:
+                    partition_results = executor(interface)
 
-            if output_suffix is not None:
-                path = path.with_suffix("." + output_suffix + path.suffix)
+                results = []
+                collect_results(results, partition_results, sink)
+        finally:
+            if sink is not None:
+                sink.close()
 
-            write_header = not path.exists()
-            output_file = path.open(mode="a", newline="")
+        logger.debug(results)
 
-            logger.info(f"{'writing' if write_header else 'APPENDING'} \
-execution results to `{path}`")
+        return results
 
-            writer = csv.DictWriter(output_file,
-                                    fieldnames=results[0]._fields,
-                                    dialect=csv.unix_dialect)
+    def _create_sink(self, output_suffix: str = None) -> ResultSink:
+        """Create a result sink for `--exec-output`, if it is set."""
+        if self.args.exec_output is None:
+            return None
 
-            if write_header:
-                writer.writeheader()
+        path = self.args.exec_output
 
-            for result in results:
-                writer.writerow(result._asdict())
+        if output_suffix is not None:
+            path = path.with_suffix("." + output_suffix + path.suffix)
 
-            output_file.close()
-            logger.info(f"done writing {len(results)} entries")
+        try:
+            return create_sink(path, self.args.exec_output_format)
+        except (OSError, ValueError) as err:
+            logger.critical(f"cannot open `{path}`: {err}")
 
-        return results
+        return None
 
     def __setup_logging(self):
         self.__stream_handler = logging.StreamHandler()
@@ -358,7 +684,7 @@ with --sumo-time")
             logger.critical("either --sumo-time-offset or \
 --sumo-time have to be specified for SUMO queries")
 
-        sumo = targeting.SumoWrapper()
+        sumo = targeting.SumoWrapper(cache=self.create_sumo_cache())
         sumoql_path = Path(string)
 
         if sumoql_path.is_file():
@@ -385,22 +711,27 @@ with --sumo-time")
 
         return macs
 
-    def __get_no_boson_macs(
-            self,
-            dr_filter: Callable[[str], bool] = lambda x: True) -> List[str]:
+    def __get_no_boson_macs(self, dr_prefix: str = "") -> MacSet:
         if self.args.interface is Interfaces.BOSON:
             logger.critical("cannot use boson interface on no_boson targets")
 
+        cache = None
+
+        if not self.args.device_registry_no_cache:
+            cache = targeting.DeviceRegistryCache(
+                    self.args.device_registry_cache,
+                    self.args.device_registry_max_age)
+
         try:
             device_registry = targeting.load_latest_device_registry(
-                    self.args.rpc_env)
+                    self.args.rpc_env, cache=cache,
+                    offline=self.args.device_registry_offline,
+                    prefix=dr_prefix)
         except targeting.TargetingError as err:
             logger.critical(f"targeting error: {err}")
         except ClientError as err:
             logger.critical(f"S3 access error: {err}")
 
-        device_registry = list(filter(dr_filter, device_registry))
-
         boson_factory = self.create_boson_factory()
         device_registry_targeting = targeting.DeviceRegistryTargeting(
                 device_registry, boson_factory=boson_factory)
@@ -409,9 +740,9 @@ with --sumo-time")
 
         return tmp_macs
 
-    def __process_targeting(self):
+    def __process_targeting(self) -> List[str]:
         string = self.args.targeting
-        macs = []
+        macs = MacSet()
 
         if string.startswith("targeting:"):
             target = string[len("targeting:"):]
@@ -436,6 +767,9 @@ with --sumo-time")
                 if getattr(self.args, key) is not None:
                     logger.warning(f"{args_key} works only for SUMO queries")
 
+        macs = macs.to_strings()
+
+        # targets are sorted, so the lowest MACs are kept
         if self.args.truncate:
             macs = macs[:self.args.devices_limit]
 
@@ -2,26 +2,43 @@
 """module containing boson interface class."""
 
 
+import asyncio
+from contextlib import contextmanager
+import functools
 from io import BytesIO
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 from random import randint
+import secrets
 import subprocess
 import tarfile
-from tempfile import NamedTemporaryFile
+import tempfile
 import threading
-from typing import List, Tuple
+import time
+from typing import IO, Callable, Dict, Iterator, List, Tuple, TypeVar
 from .argparse_type import irange
 from .command import CommandType, CommandBuffer
 from . import interface
-from .ratelimit import Ratelimit
+from .ratelimit import TokenBucket
+from .ssh_mux import SSHMultiplexer
+from . import tar_codec
 from . import targeting
 from . import template
+from .upload_cache import StagedUpload, UploadCache
 
 
 FIRST_INDEX = 1
 LAST_INDEX = 99
 
+# per-command result files written by `boson_base.sh`
+RESULT_PARAMS = ("rc", "stdout", "stderr")
+
+# default limit of stdout/stderr size of a single command
+MAX_OUTPUT_SIZE = 1 << 20
+
+T = TypeVar("T")
+
 
 logger = logging.getLogger(__name__)
 
@@ -67,21 +84,235 @@ index, but got first ({}) >= last ({})".format(first, last))
         return index
 
 
+class BosonHostStats:
+    """Health and load statistics of a single boson server."""
+
+    def __init__(self):
+        """Construct empty statistics."""
+        self.latency = None
+        self.failure_rate = 0.
+        self.failures = 0
+        self.inflight = 0
+        self.retry_at = 0.
+
+
+class BosonPool:
+    """Latency- and health-aware boson server selection.
+
+    Hands out the boson index with the lowest expected latency, which is
+    the connect latency weighted by the failure rate and the number of
+    partitions already running on the server. Servers that failed
+    `FAILURE_THRESHOLD` times in a row are skipped for a cooldown period
+    that doubles with every further failure. No server gets more than
+    `max_inflight` partitions at a time.
+    """
+
+    # weight of the latest observation in latency and failure rate averages
+    WEIGHT = 0.3
+    FAILURE_THRESHOLD = 2
+    COOLDOWN = 30.
+    MAX_COOLDOWN = 600.
+
+    def __init__(self, first: int = None, last: int = None,
+                 max_inflight: int = 4, retries: int = 2):
+        """Class constructor.
+
+        Arguments:
+            first: first boson index in the pool.
+            last: last boson index in the pool.
+            max_inflight: maximum number of partitions per server.
+            retries: number of other servers an interface tries when
+                     the selected one fails to connect.
+        """
+        if first is None:
+            first = FIRST_INDEX
+
+        if last is None:
+            last = LAST_INDEX
+
+        self.max_inflight = max_inflight
+        self.retries = retries
+        self.stats = {
+                index: BosonHostStats()
+                for index in range(first, last + 1)
+                }
+
+        self.__cv = threading.Condition()
+
+    def acquire(self) -> int:
+        """Select a boson index, blocks while all servers are at capacity."""
+        with self.__cv:
+            index = None
+
+            while index is None:
+                index = self.__select()
+
+                if index is None:
+                    self.__cv.wait()
+
+            self.stats[index].inflight += 1
+
+        return index
+
+    def release(self, index: int, failed: bool = False):
+        """Return an index acquired with `acquire()`.
+
+        Arguments:
+            index: boson index.
+            failed: whether the server failed to serve the partition.
+        """
+        with self.__cv:
+            self.stats[index].inflight -= 1
+            self.__record(index, failed)
+            self.__cv.notify_all()
+
+    def report(self, index: int, latency: float):
+        """Report connect latency in seconds for a boson server."""
+        with self.__cv:
+            stats = self.stats[index]
+
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.WEIGHT * (latency - stats.latency)
+
+    def probe(self, processes: int = 16, **kwargs):
+        """Measure connect latency of every server in the pool.
+
+        Arguments:
+            processes: number of servers to probe in parallel.
+            kwargs: `BosonInterface` keyword arguments.
+        """
+        logger.info(f"probing {len(self.stats)} boson servers")
+
+        with ThreadPool(processes=processes) as pool:
+            pool.map(functools.partial(self.__probe, **kwargs), self.stats)
+
+        healthy = [
+                (stats.latency, index)
+                for index, stats in self.stats.items()
+                if stats.failures == 0 and stats.latency is not None
+                ]
+
+        logger.info(f"{len(healthy)} out of {len(self.stats)} boson servers \
+are healthy")
+
+        if healthy:
+            latency, index = min(healthy)
+
+            logger.info(f"fastest boson server is boson{index}, \
+{latency:.3f}s to connect")
+
+    def __probe(self, index: int, **kwargs):
+        boson_interface = BosonInterface([], boson_index=index, **kwargs)
+        start = time.monotonic()
+
+        try:
+            boson_interface.open()
+            self.report(index, time.monotonic() - start)
+
+            failed = False
+        except interface.FatalInterfaceError as err:
+            logger.warning(f"boson{index} probe failed: {err}")
+
+            failed = True
+        finally:
+            boson_interface.close()
+
+        with self.__cv:
+            self.__record(index, failed)
+
+    def __record(self, index: int, failed: bool):
+        stats = self.stats[index]
+        stats.failure_rate += self.WEIGHT * (float(failed) -
+                                             stats.failure_rate)
+
+        if not failed:
+            stats.failures = 0
+
+            return
+
+        stats.failures += 1
+
+        if stats.failures >= self.FAILURE_THRESHOLD:
+            cooldown = min(self.COOLDOWN * 2 ** (stats.failures -
+                                                 self.FAILURE_THRESHOLD),
+                           self.MAX_COOLDOWN)
+            stats.retry_at = time.monotonic() + cooldown
+
+            logger.warning(f"boson{index} failed {stats.failures} times \
+in a row, skipping it for {cooldown:.0f}s")
+
+    def __select(self) -> int:
+        mono = time.monotonic()
+        available = [
+                (index, stats)
+                for index, stats in self.stats.items()
+                if stats.inflight < self.max_inflight
+                ]
+
+        if not available:
+            return None
+
+        healthy = [
+                (index, stats)
+                for index, stats in available
+                if stats.retry_at <= mono
+                ]
+
+        if not healthy:
+            if any(stats.retry_at <= mono for stats in self.stats.values()):
+                # healthy servers exist, they are just busy
+                return None
+
+            # everything is in cooldown, use the server that recovers first
+            return min(available, key=lambda item: item[1].retry_at)[0]
+
+        def score(item):
+            _, stats = item
+            latency = 0. if stats.latency is None else stats.latency
+
+            return (latency * (stats.inflight + 1) *
+                    (1 + 4 * stats.failure_rate), stats.inflight)
+
+        return min(healthy, key=score)[0]
+
+
 class BosonInterface(interface.Interface):
     """Boson interface implementation."""
 
     SCRIPT_NAME = "boson_base.sh"
+    METRICS_PREFIX = "boson"
+    # every partition pays for a handshake and an archive round trip,
+    # tail partitions of a few devices aren't worth it
+    MIN_PARTITION_SIZE = 8
+
+    # shared by all partitions, uploads are stored under their sha256
+    UPLOAD_CACHE_DIR = "$HOME/.frpc-cache"
+    # uploads neither sent nor read for that many days are removed
+    UPLOAD_CACHE_MAX_AGE = 30
 
     validate_index = irange(FIRST_INDEX, LAST_INDEX)
 
     # since all boson requests go through the `boson-ssh`,
     # we have to ratelimit the number of connections per second to 4
-    __ratelimit = Ratelimit(1 / 4)
+    __ratelimit = TokenBucket(4, burst=4)
+
+    # with multiplexing the ratelimit applies only to new master connections
+    __multiplexer = SSHMultiplexer(ratelimit=__ratelimit)
 
     __index_generator = BosonIndexGenerator()
 
+    __upload_cache = UploadCache()
+
+    __remote_tools = tar_codec.RemoteTools()
+
     def __init__(self, macs: List[str], *args, boson_index=None,
-                 index_generator=None, **kwargs):
+                 index_generator=None, multiplex: bool = True,
+                 stream_results: bool = True, remote_parallelism: int = 1,
+                 boson_pool: BosonPool = None, codec: str = "auto",
+                 codec_level: int = None,
+                 max_output_size: int = MAX_OUTPUT_SIZE, **kwargs):
         """Boson interface contructor.
 
         Arguments:
@@ -90,9 +321,36 @@ class BosonInterface(interface.Interface):
                 use, leave this as None to randomly generate a suitable index,
                 or pass a tuple to specify the index range for the
                 random generator.
+            multiplex: route all ssh calls through one persistent master
+                connection per boson server.
+            stream_results: receive the results tarball on stdout of the
+                execution ssh session, otherwise store it on boson and
+                fetch it with scp.
+            remote_parallelism: number of devices the boson side processes
+                concurrently.
+            boson_pool: select the boson server from the pool when the
+                interface is opened, `boson_index` is ignored.
+            codec: compression of the archive sent to boson, one of
+                `tar_codec.CODEC_CHOICES`, see `tar_codec.select_codec()`.
+            codec_level: compression level, codec default if None.
+            max_output_size: stdout/stderr of a single command is truncated
+                to this number of bytes.
         """
         super().__init__(macs, *args, **kwargs)
 
+        self.multiplexer = self.__multiplexer if multiplex else None
+        self.stream_results = stream_results
+        self.remote_parallelism = remote_parallelism
+        self.boson_pool = boson_pool
+        self.codec = codec
+        self.codec_level = codec_level
+        self.max_output_size = max_output_size
+        self.__failed = False
+
+        if boson_pool is not None:
+            self.boson_index = None
+            return
+
         if index_generator is None:
             index_generator = self.__index_generator
 
@@ -110,69 +368,200 @@ class BosonInterface(interface.Interface):
 
             return
 
-        logger.info(f"using {self.__mkserver()}")
-        logger.debug("trying to open an interface")
+        if self.boson_pool is None:
+            self.__open()
+
+            return
+
+        attempts = self.boson_pool.retries + 1
+
+        for attempt in range(1, attempts + 1):
+            self.boson_index = self.boson_pool.acquire()
+            start = time.monotonic()
+
+            try:
+                self.__open()
+            except interface.FatalInterfaceError as err:
+                self.boson_pool.release(self.boson_index, failed=True)
+
+                if attempt == attempts:
+                    raise
+
+                logger.warning(f"{err}, trying another boson server")
+
+                continue
+            except BaseException:
+                # e.g. a timeout or an interrupt, the slot must not leak
+                self.boson_pool.release(self.boson_index, failed=True)
+
+                raise
+
+            self.boson_pool.report(self.boson_index,
+                                   time.monotonic() - start)
+
+            return
+
+    async def open_async(self):
+        """Open a connection over boson from a coroutine."""
+        if self.is_open:
+            logger.debug("interface already open")
+
+            return
+
+        if self.boson_pool is None:
+            await self.__open_async()
+
+            return
+
+        attempts = self.boson_pool.retries + 1
+
+        for attempt in range(1, attempts + 1):
+            self.boson_index = await interface.run_blocking(
+                    self.boson_pool.acquire)
+            start = time.monotonic()
+
+            try:
+                await self.__open_async()
+            except interface.FatalInterfaceError as err:
+                self.boson_pool.release(self.boson_index, failed=True)
+
+                if attempt == attempts:
+                    raise
+
+                logger.warning(f"{err}, trying another boson server")
+
+                continue
+            except BaseException:
+                # e.g. a timeout or an interrupt, the slot must not leak
+                self.boson_pool.release(self.boson_index, failed=True)
+
+                raise
+
+            self.boson_pool.report(self.boson_index,
+                                   time.monotonic() - start)
+
+            return
+
+    def close(self):
+        """Close the connection and return the server to the pool."""
+        if self.is_open and self.boson_pool is not None:
+            self.boson_pool.release(self.boson_index, failed=self.__failed)
+
+        super().close()
+
+    def __open(self):
+        salt, cmd_format = self.__mkopen()
 
         try:
-            salt = self.__mksalt()
-            cproc = self.__execute(f"ssh {{server}} 'echo -n {salt}'",
+            cproc = self.__execute(cmd_format, "handshake",
                                    capture_output=True, timeout=15)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
+            raise self.__mkopen_error(err) from err
 
-            if cproc.stdout != salt:
-                raise interface.FatalInterfaceError(
-                        f"Expected `{salt}` from boson, got `{cproc.stdout}`")
+        self.__check_salt(salt, cproc.stdout)
 
-            self.is_open = True
-        except subprocess.CalledProcessError as err:
-            raise interface.FatalInterfaceError(f"\
-ssh call failed with code {err.returncode} (no vpn?): \
-cmd = `{err.cmd}`, \
-stdout = `{err.stdout}`, \
-stderr = `{err.stderr}`") from err
-        except subprocess.TimeoutExpired as err:
-            raise interface.FatalInterfaceError("Boson connection timeout. \
-(bad VPN connection?)") from err
+    async def __open_async(self):
+        salt, cmd_format = self.__mkopen()
+
+        try:
+            cproc = await self.__execute_async(cmd_format, "handshake",
+                                               capture_output=True,
+                                               timeout=15)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
+            raise self.__mkopen_error(err) from err
+
+        self.__check_salt(salt, cproc.stdout)
 
     def execute(self, command_buffer: CommandBuffer) \
             -> List[interface.ExecutionResult]:
         """Execute the list of commands stored in the command_buffer."""
         commands = command_buffer.flush()
-        filename, work_dir = self.__create_tar(commands)
-        results = []
+        staged = self.__sync_uploads(commands)
 
-        try:
-            remote_tar = f"{work_dir}.tar.gz"
-            self.__execute(f"\
-cat '{filename}' \
-| ssh {{server}} '\
-tar -xz --warning=no-timestamp \
-&& cd {work_dir} \
-&& ./scripts/{self.SCRIPT_NAME}; \
-rc=$?; \
-cd $OLDPWD; \
-[[ $rc -eq 0 ]] && tar -czf {remote_tar} {work_dir}; \
-rm -r {work_dir}; \
-exit $rc\
-'")
+        with self._timer("create_tar"):
+            archive, work_dir = self.__create_tar(commands, staged)
 
-            self.__execute(f"scp {{server}}:{remote_tar} {filename}")
-            self.__execute(f"ssh {{server}} 'rm {remote_tar}'")
+        codec = self.__select_codec(len(archive))
 
-            results = self.__unpack_results(commands, filename, work_dir)
-        except subprocess.CalledProcessError as err:
-            raise interface.InterfaceError(f"""\
-One of the ssh calls failed (no vpn?), \
-you may have to manually log into boson and remove temporary files.
-The command failed with code {err.returncode}:
-cmd = `{err.cmd}`,
-stdout = `{err.stdout}`,
-stderr = `{err.stderr}`""") from err
+        with self._timer("compress"):
+            payload = codec.compress(archive,
+                                     codec.clamp_level(self.codec_level))
+
+        try:
+            if self.stream_results:
+                return self.__execute_stream(
+                        self.__mkexec_stream(work_dir, codec), "remote",
+                        payload, functools.partial(self.__unpack_results,
+                                                   commands,
+                                                   work_dir=work_dir))
+
+            with self.__results_file() as filename:
+                for cmd_format, phase, stdin_data in self.__mkexec(
+                        work_dir, codec, payload, filename):
+                    self.__execute(cmd_format, phase, stdin_data=stdin_data)
+
+                with open(filename, "rb") as fileobj:
+                    return self.__unpack_results(commands, fileobj, work_dir)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
+            self.__failed = True
+
+            raise self.__mkexec_error(err) from err
+        except tarfile.ReadError as err:
+            self.__failed = True
+
+            raise interface.InterfaceError(
+                    f"invalid results archive: {err}") from err
         # pylint: disable=fixme
         # TODO: add a timeout handler
-        finally:
-            os.unlink(filename)
 
-        return results
+    async def execute_async(self, command_buffer: CommandBuffer) \
+            -> List[interface.ExecutionResult]:
+        """Execute the list of commands stored in the command_buffer.
+
+        Same as `execute()`, but ssh calls are driven by the event loop.
+        """
+        commands = command_buffer.flush()
+        staged = await interface.run_blocking(self.__sync_uploads, commands)
+
+        with self._timer("create_tar"):
+            archive, work_dir = self.__create_tar(commands, staged)
+
+        codec = await interface.run_blocking(self.__select_codec,
+                                             len(archive))
+
+        with self._timer("compress"):
+            payload = codec.compress(archive,
+                                     codec.clamp_level(self.codec_level))
+
+        try:
+            if self.stream_results:
+                return await self.__execute_stream_async(
+                        self.__mkexec_stream(work_dir, codec), "remote",
+                        payload, functools.partial(self.__unpack_results,
+                                                   commands,
+                                                   work_dir=work_dir))
+
+            with self.__results_file() as filename:
+                for cmd_format, phase, stdin_data in self.__mkexec(
+                        work_dir, codec, payload, filename):
+                    await self.__execute_async(cmd_format, phase,
+                                               stdin_data=stdin_data)
+
+                with open(filename, "rb") as fileobj:
+                    return self.__unpack_results(commands, fileobj, work_dir)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
+            self.__failed = True
+
+            raise self.__mkexec_error(err) from err
+        except tarfile.ReadError as err:
+            self.__failed = True
+
+            raise interface.InterfaceError(
+                    f"invalid results archive: {err}") from err
 
     def get_online(self) -> List[str]:
         """Return list of active devices in `self.mac`.
@@ -197,23 +586,101 @@ script_body=$(cat << {eof}
 {script_body_esc}
 {eof}
 )
-ssh {{server}} "$script_body"
-""", capture_output=True)
+{{ssh}} {{server}} "$script_body"
+""", "get_online", capture_output=True)
 
             prefixes_online = targeting.fix_macs(cproc.stdout.splitlines())
             devices_online = targeting.device_registry_select(
-                    self.macs, prefixes_online)
+                    targeting.fix_macs(self.macs), prefixes_online)
 
             logger.debug(f"prefixes_online = {len(prefixes_online)}, \
 online from device registry = {len(devices_online)}")
 
-            return devices_online
-        except subprocess.CalledProcessError as err:
+            return devices_online.to_strings()
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
             raise interface.InterfaceError("SSH call failed") from err
         except targeting.ParseError as err:
             raise interface.InterfaceError("script output format error") \
                     from err
 
+    def __mkopen(self) -> Tuple[str, str]:
+        logger.info(f"using {self.__mkserver()}")
+        logger.debug("trying to open an interface")
+
+        salt = self.__mksalt()
+
+        return salt, f"{{ssh}} {{server}} 'echo -n {salt}'"
+
+    def __check_salt(self, salt: str, stdout: str):
+        if stdout != salt:
+            raise interface.FatalInterfaceError(
+                    f"Expected `{salt}` from boson, got `{stdout}`")
+
+        self.is_open = True
+
+    @staticmethod
+    def __mkopen_error(err: subprocess.SubprocessError) \
+            -> interface.FatalInterfaceError:
+        if isinstance(err, subprocess.TimeoutExpired):
+            return interface.FatalInterfaceError("Boson connection timeout. \
+(bad VPN connection?)")
+
+        return interface.FatalInterfaceError(f"\
+ssh call failed with code {err.returncode} (no vpn?): \
+cmd = `{err.cmd}`, \
+stdout = `{err.stdout}`, \
+stderr = `{err.stderr}`")
+
+    def __mkexec(self, work_dir: str, codec: tar_codec.Codec,
+                 payload: bytes, filename: str) \
+            -> List[Tuple[str, str, bytes]]:
+        remote_tar = f"{work_dir}.tar.gz"
+        remote_pack = f"tar -czf {remote_tar} {work_dir}"
+
+        return [
+                (self.__mkexec_remote(work_dir, codec, remote_pack),
+                 "remote", payload),
+                (f"{{scp}} {{server}}:{remote_tar} {filename}", "scp", None),
+                (f"{{ssh}} {{server}} 'rm {remote_tar}'", "cleanup", None),
+                ]
+
+    def __mkexec_stream(self, work_dir: str, codec: tar_codec.Codec) -> str:
+        # the results tarball is the only thing written to stdout,
+        # script output is redirected to stderr
+        return self.__mkexec_remote(work_dir, codec, f"tar -cz {work_dir}",
+                                    "1>&2")
+
+    def __mkexec_remote(self, work_dir: str, codec: tar_codec.Codec,
+                        remote_pack: str, redirect: str = "") -> str:
+        # the archive comes on stdin
+        return f"\
+{{ssh}} {{server}} '\
+{codec.extract_cmd} --warning=no-timestamp \
+&& cd {work_dir} \
+&& ./scripts/{self.SCRIPT_NAME} {redirect}; \
+rc=$?; \
+cd $OLDPWD; \
+[[ $rc -eq 0 ]] && {remote_pack}; \
+rm -r {work_dir}; \
+exit $rc\
+'"
+
+    @staticmethod
+    def __mkexec_error(err: subprocess.SubprocessError) \
+            -> interface.InterfaceError:
+        if isinstance(err, subprocess.TimeoutExpired):
+            return interface.InterfaceError(f"\
+ssh master connection timeout (bad VPN connection?): cmd = `{err.cmd}`")
+
+        return interface.InterfaceError(f"""\
+One of the ssh calls failed (no vpn?), \
+you may have to manually log into boson and remove temporary files.
+The command failed with code {err.returncode}:
+cmd = `{err.cmd}`,
+stdout = `{err.stdout}`,
+stderr = `{err.stderr}`""")
+
     @staticmethod
     def __mksalt():
         return str(randint(0, 10 ** 9))
@@ -221,15 +688,89 @@ online from device registry = {len(devices_online)}")
     def __mkserver(self):
         return f"boson-boson{self.boson_index}"
 
-    def __execute(self, cmd_format: str, capture_output: bool = False,
-                  timeout: int = None) -> subprocess.CompletedProcess:
+    def __mkcmd(self, cmd_format: str) -> str:
+        server = self.__mkserver()
+
+        if self.multiplexer is None:
+            return cmd_format.format(server=server, ssh="ssh", scp="scp")
+
+        return cmd_format.format(server=server,
+                                 ssh=self.multiplexer.ssh_command(server),
+                                 scp=self.multiplexer.scp_command(server))
+
+    def __connect(self):
+        if self.multiplexer is None:
+            with self._timer("ratelimit"):
+                self.__ratelimit.acquire()
+        else:
+            with self._timer("ssh_connect"):
+                self.multiplexer.connect(self.__mkserver())
+
+    async def __connect_async(self):
+        if self.multiplexer is None:
+            with self._timer("ratelimit"):
+                await self.__ratelimit.acquire_async()
+        else:
+            with self._timer("ssh_connect"):
+                await interface.run_blocking(self.multiplexer.connect,
+                                             self.__mkserver())
+
+    def __execute(self, cmd_format: str, phase: str,
+                  capture_output: bool = False, timeout: int = None,
+                  stdin_data: bytes = None) -> subprocess.CompletedProcess:
+
+        cmd = self.__mkcmd(cmd_format)
+
+        self.__connect()
+
+        with self._timer(phase):
+            return self.__run(cmd, capture_output, timeout, stdin_data)
+
+    async def __execute_async(self, cmd_format: str, phase: str,
+                              capture_output: bool = False,
+                              timeout: int = None,
+                              stdin_data: bytes = None) \
+            -> subprocess.CompletedProcess:
+
+        cmd = self.__mkcmd(cmd_format)
 
-        cmd = cmd_format.format(server=self.__mkserver())
+        await self.__connect_async()
 
-        with self.__ratelimit:
-            logger.debug(f"running shell command `{cmd}`")
+        with self._timer(phase):
+            return await self.__run_async(cmd, capture_output, timeout,
+                                          stdin_data)
 
-            cproc = subprocess.run(cmd, shell=True, text=True,
+    def __execute_stream(self, cmd_format: str, phase: str,
+                         stdin_data: bytes,
+                         consume: Callable[[IO[bytes]], T]) -> T:
+        cmd = self.__mkcmd(cmd_format)
+
+        self.__connect()
+
+        with self._timer(phase):
+            return self.__run_stream(cmd, stdin_data, consume)
+
+    async def __execute_stream_async(self, cmd_format: str, phase: str,
+                                     stdin_data: bytes,
+                                     consume: Callable[[IO[bytes]], T]) -> T:
+        cmd = self.__mkcmd(cmd_format)
+
+        await self.__connect_async()
+
+        # ssh is driven by the event loop, only the finished archive is
+        # unpacked on an executor thread
+        with self._timer(phase):
+            stdout = await self.__run_stream_async(cmd, stdin_data)
+
+        return await interface.run_blocking(consume, BytesIO(stdout))
+
+    @staticmethod
+    def __run(cmd: str, capture_output: bool, timeout: int,
+              stdin_data: bytes = None) -> subprocess.CompletedProcess:
+        logger.debug(f"running shell command `{cmd}`")
+
+        if stdin_data is not None:
+            cproc = subprocess.run(cmd, shell=True, input=stdin_data,
                                    capture_output=capture_output, check=True,
                                    timeout=timeout)
 
@@ -237,9 +778,138 @@ online from device registry = {len(devices_online)}")
 
             return cproc
 
-    def __mkscript(self, commands: List[tuple]) -> Tuple[str, List[tuple]]:
+        cproc = subprocess.run(cmd, shell=True, text=True,
+                               capture_output=capture_output, check=True,
+                               timeout=timeout)
+
+        logger.debug(f"shell command complete: {cproc}")
+
+        return cproc
+
+    @staticmethod
+    async def __run_async(cmd: str, capture_output: bool, timeout: int,
+                          stdin_data: bytes = None) \
+            -> subprocess.CompletedProcess:
+        logger.debug(f"running shell command `{cmd}`")
+
+        pipe = asyncio.subprocess.PIPE if capture_output else None
+        proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdin=None if stdin_data is None else asyncio.subprocess.PIPE,
+                stdout=pipe,
+                stderr=pipe)
+
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(stdin_data), timeout)
+        except asyncio.TimeoutError as err:
+            proc.kill()
+            await proc.wait()
+
+            raise subprocess.TimeoutExpired(cmd, timeout) from err
+
+        if stdout is not None:
+            stdout = stdout.decode()
+
+        if stderr is not None:
+            stderr = stderr.decode()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                stdout, stderr)
+
+        cproc = subprocess.CompletedProcess(cmd, proc.returncode,
+                                            stdout, stderr)
+
+        logger.debug(f"shell command complete: {cproc}")
+
+        return cproc
+
+    @staticmethod
+    def __run_stream(cmd: str, stdin_data: bytes,
+                     consume: Callable[[IO[bytes]], T]) -> T:
+        """Run `cmd`, feed it `stdin_data` and pass its stdout to `consume`.
+
+        Throws:
+            subprocess.CalledProcessError: `cmd` failed.
+            tarfile.ReadError: `consume` couldn't read the output of `cmd`,
+                               which succeeded.
+        """
+        logger.debug(f"running shell command `{cmd}`")
+
+        def feed(stdin):
+            # the remote side may exit without reading the whole input
+            try:
+                stdin.write(stdin_data)
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+        with subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE) as proc:
+            feeder = threading.Thread(target=feed, args=(proc.stdin,),
+                                      daemon=True)
+            feeder.start()
+
+            try:
+                result = consume(proc.stdout)
+                error = None
+            except tarfile.ReadError as err:
+                result, error = None, err
+            except BaseException:
+                proc.kill()
+
+                raise
+
+            # drain what the consumer didn't need, e.g. the archive padding
+            while proc.stdout.read(1 << 16):
+                pass
+
+            feeder.join()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        if error is not None:
+            raise error
+
+        logger.debug(f"shell command complete: returncode = \
+{proc.returncode}")
+
+        return result
+
+    @staticmethod
+    async def __run_stream_async(cmd: str, stdin_data: bytes) -> bytes:
+        """Run `cmd`, feed it `stdin_data` and return its stdout.
+
+        Throws:
+            subprocess.CalledProcessError: `cmd` failed.
+        """
+        logger.debug(f"running shell command `{cmd}`")
+
+        proc = await asyncio.create_subprocess_shell(
+                cmd, stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE)
+
+        try:
+            stdout, _ = await proc.communicate(stdin_data)
+        except BaseException:
+            proc.kill()
+            await proc.wait()
+
+            raise
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        logger.debug(f"shell command complete: returncode = \
+{proc.returncode}, stdout = {len(stdout)} bytes")
+
+        return stdout
+
+    def __mkscript(self, commands: List[tuple],
+                   staged: Dict[str, StagedUpload]) -> str:
         iter_body = ""
-        uploads = []
 
         for i, (command_type, *command_args) in enumerate(commands):
             if command_type is CommandType.EXEC:
@@ -253,32 +923,30 @@ online from device registry = {len(devices_online)}")
     boson_ssh {i} $mac "$script_body{i}"'''
             elif command_type is CommandType.UPLOAD:
                 remote_path, local_path = command_args
-                local_name = os.path.basename(local_path)
-                boson_path = f"uploads/{i}/{local_name}"
-                iter_body += f"boson_scp {i} $mac {boson_path} \
-$mac:\\'{remote_path}\\''"
-
-                uploads.append((boson_path, local_path))
-
-        return iter_body, uploads
+                boson_path = \
+                    f"{self.UPLOAD_CACHE_DIR}/{staged[local_path].digest}"
+                iter_body += f'''
+    boson_scp {i} $mac "{boson_path}" "$mac:'{remote_path}'"'''
 
-    def __create_tar(self, commands: List[tuple]) -> Tuple[str, str]:
-        suffix = ".tar.gz"
-        fileobj = NamedTemporaryFile(suffix=suffix, prefix=__name__,
-                                     delete=False)
+        return iter_body
 
-        work_dir = os.path.basename(fileobj.name.replace(suffix, ""))
-        iter_body, uploads = self.__mkscript(commands)
+    def __create_tar(self, commands: List[tuple],
+                     staged: Dict[str, StagedUpload]) -> Tuple[bytes, str]:
+        """Build the uncompressed archive in memory.
 
-        with tarfile.open(mode="w:gz", fileobj=fileobj) as tarobj:
-            for boson_path, local_path in uploads:
-                tarobj.add(local_path,
-                           arcname=os.path.join(work_dir, boson_path))
+        Returns:
+            archive bytes and the name of its top directory.
+        """
+        work_dir = f"{__name__}{secrets.token_hex(4)}"
+        iter_body = self.__mkscript(commands, staged)
+        fileobj = BytesIO()
 
+        with tarfile.open(mode="w|", fileobj=fileobj) as tarobj:
             macs = f'macs="{" ".join(self.macs)}"'
-            script_bytes = template.load_template(self.SCRIPT_NAME,
-                                                  macs=macs,
-                                                  iter_body=iter_body).encode()
+            parallelism = f"parallelism={self.remote_parallelism}"
+            script_bytes = template.load_template(
+                    self.SCRIPT_NAME, macs=macs, parallelism=parallelism,
+                    iter_body=iter_body).encode()
 
             tarinfo = tarfile.TarInfo(
                     os.path.join(work_dir, "scripts", self.SCRIPT_NAME))
@@ -288,54 +956,185 @@ $mac:\\'{remote_path}\\''"
 
             tarobj.addfile(tarinfo, BytesIO(script_bytes))
 
-        fileobj.close()
+        return fileobj.getvalue(), work_dir
+
+    def __select_codec(self, size: int) -> tar_codec.Codec:
+        codec = tar_codec.select_codec(
+                self.codec, size,
+                lambda: self.__remote_tools.get(self.__mkserver(),
+                                                self.__probe_tools))
+
+        logger.debug(f"sending {size} bytes archive with {codec.name} codec")
 
-        return fileobj.name, work_dir
+        return codec
+
+    def __probe_tools(self) -> List[str]:
+        cproc = self.__execute(
+                f"{{ssh}} {{server}} '{tar_codec.RemoteTools.probe_cmd()}'",
+                "codec_probe", capture_output=True)
+
+        return cproc.stdout.split()
 
     @staticmethod
-    def __read_param(tarobj: tarfile.TarFile, filepath):
+    @contextmanager
+    def __results_file() -> Iterator[str]:
+        """Temporary local file for results fetched with scp."""
+        fd, filename = tempfile.mkstemp(suffix=".tar.gz", prefix=__name__)
+        os.close(fd)
+
         try:
-            reader = tarobj.extractfile(filepath)
-        except KeyError:
-            return None
+            yield filename
+        finally:
+            os.unlink(filename)
+
+    def __sync_uploads(self, commands: List[tuple]) \
+            -> Dict[str, StagedUpload]:
+        """Make sure the boson server has every file the commands upload.
+
+        Returns:
+            staged uploads by local path.
+        """
+        local_paths = {
+                command_args[1]
+                for command_type, *command_args in commands
+                if command_type is CommandType.UPLOAD
+                }
+
+        if not local_paths:
+            return {}
+
+        try:
+            staged = {
+                    local_path: self.__upload_cache.stage(local_path)
+                    for local_path in local_paths
+                    }
+        except OSError as err:
+            raise interface.FatalInterfaceError(
+                    f"cannot stage upload: {err}") from err
 
-        if reader is None:
-            logger.error(f"boson archive: `{filepath}` is not a file")
+        try:
+            with self._timer("upload"):
+                self.__upload_cache.ensure_remote(
+                        self.__mkserver(), staged.values(),
+                        self.__list_remote_uploads, self.__transfer_upload)
+        except (subprocess.CalledProcessError,
+                subprocess.TimeoutExpired) as err:
+            self.__failed = True
+
+            raise self.__mkexec_error(err) from err
+
+        return staged
+
+    def __list_remote_uploads(self) -> List[str]:
+        # the cache is pruned once per host before it's listed; reads
+        # refresh atime (relatime), so uploads in use aren't removed, and
+        # leftovers of interrupted transfers go after a day
+        cproc = self.__execute(f"\
+{{ssh}} {{server}} '\
+find {self.UPLOAD_CACHE_DIR} -maxdepth 1 -type f \\( \
+\\( -atime +{self.UPLOAD_CACHE_MAX_AGE} \
+-mtime +{self.UPLOAD_CACHE_MAX_AGE} \\) \
+-o \\( -name \"*.part.*\" -mtime +1 \\) \\) -delete 2>/dev/null; \
+ls {self.UPLOAD_CACHE_DIR} 2>/dev/null; \
+true'", "upload_list", capture_output=True)
+
+        return [
+                name
+                for name in cproc.stdout.split()
+                if len(name) == 64
+                ]
+
+    def __transfer_upload(self, item: StagedUpload):
+        path = f"{self.UPLOAD_CACHE_DIR}/{item.digest}"
+        tmp_path = f"{path}.part.$$"
+
+        # the file is sent compressed and verified before it becomes visible
+        self.__execute(f"\
+cat '{item.compressed_path}' \
+| {{ssh}} {{server}} '\
+mkdir -p {self.UPLOAD_CACHE_DIR} \
+&& gzip -dc > {tmp_path} \
+&& echo \"{item.digest}  {tmp_path}\" | sha256sum -c --quiet \
+&& mv {tmp_path} {path} \
+|| {{{{ rm -f {tmp_path}; exit 1; }}}}\
+'", "upload_transfer")
+
+    def __read_member(self, tarobj: tarfile.TarFile,
+                      member: tarfile.TarInfo) -> str:
+        reader = tarobj.extractfile(member)
+        data = reader.read(self.max_output_size)
+        text = data.decode("utf-8", errors="replace")
+
+        if member.size > len(data):
+            logger.warning(f"boson archive: `{member.name}` is truncated \
+to {len(data)} out of {member.size} bytes")
+
+            text += f"\n[truncated {member.size - len(data)} bytes]"
+
+        return text
 
+    @staticmethod
+    def __parse_returncode(returncode: str) -> int:
+        if returncode is None:
             return None
 
-        return reader.read().decode("utf-8")
+        try:
+            return int(returncode)
+        except ValueError:
+            logger.exception(f"returncode `{returncode}` is not an integer")
 
-    def __unpack_results(self, commands, filename, work_dir):
-        results = []
+        return None
 
-        with tarfile.open(filename) as tarobj:
-            for mac in self.macs:
-                for i, _ in enumerate(commands):
-                    returncode = self.__read_param(
-                            tarobj, f"{work_dir}/results/{mac}/rc.{i}")
+    def __unpack_results(self, commands, fileobj, work_dir):
+        """Read the results archive in a single sequential pass.
 
-                    if returncode is not None:
-                        try:
-                            returncode = int(returncode)
-                        except ValueError:
-                            logger.exception(f"\
-returncode `{returncode}` is not an integer")
+        `fileobj` may be a pipe. At most `max_output_size` bytes of every
+        member are read, the rest is skipped.
 
-                            returncode = None
+        Members are `<work_dir>/results/<mac>/{rc,stdout,stderr}.<i>`, they
+        are routed to their (mac, command) slot as they stream by. Results
+        are ordered by MAC, then by command.
+        """
+        prefix = f"{work_dir}/results/"
+        macs = set(self.macs)
+        params: Dict[Tuple[str, int], Dict[str, str]] = {}
+
+        with self._timer("unpack"), \
+                tarfile.open(fileobj=fileobj, mode="r|*") as tarobj:
+            for member in tarobj:
+                if not member.name.startswith(prefix):
+                    continue
+
+                mac, _, param = member.name[len(prefix):].partition("/")
+                kind, _, index = param.partition(".")
+
+                if mac not in macs or kind not in RESULT_PARAMS or \
+                        not index.isdigit():
+                    continue
 
-                    stdout = self.__read_param(
-                            tarobj, f"{work_dir}/results/{mac}/stdout.{i}")
+                if not member.isfile():
+                    logger.error(f"boson archive: `{member.name}` \
+is not a file")
+
+                    continue
+
+                params.setdefault((mac, int(index)), {})[kind] = \
+                    self.__read_member(tarobj, member)
+
+        results = []
 
-                    stderr = self.__read_param(
-                            tarobj, f"{work_dir}/results/{mac}/stderr.{i}")
+        for mac in self.macs:
+            for i, _ in enumerate(commands):
+                values = params.pop((mac, i), {})
+                returncode = self.__parse_returncode(values.get("rc"))
 
-                    result = interface.ExecutionResult(
-                            mac=mac, returncode=returncode,
-                            success=returncode == 0,
-                            stdout=stdout, stderr=stderr)
+                result = interface.ExecutionResult(
+                        mac=mac, returncode=returncode,
+                        success=returncode == 0,
+                        stdout=values.get("stdout"),
+                        stderr=values.get("stderr"))
 
-                    results.append(result)
+                results.append(result)
 
         return results
 
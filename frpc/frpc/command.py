@@ -2,9 +2,6 @@
 """Module containing remote command containers and helpers."""
 
 from enum import Enum, auto
-import os
-import tarfile
-from tempfile import NamedTemporaryFile
 from typing import List
 
 
@@ -16,7 +13,12 @@ class CommandType(Enum):
 
 
 class CommandBuffer:
-    """A container to optimize the number of interface calls."""
+    """A container to optimize the number of interface calls.
+
+    Consecutive EXEC commands are merged into a single script. Every UPLOAD
+    command becomes a `(CommandType.UPLOAD, remote_path, local_path)` entry,
+    interfaces stage and transfer the files themselves, see `upload_cache`.
+    """
 
     def __init__(self):
         """Construct an empty buffer."""
@@ -29,20 +31,13 @@ class CommandBuffer:
         self.__last_cmd = None
         self.__last_script_body = ""
         self.__last_uploads = []
-        self.__last_index = 0
-        self.__files_to_unlink = []
-
-    def __del__(self):
-        """Class destructor to unlink temp files."""
-        self.__unlink()
 
     def __enter__(self):
         """Enter function to make the class context manager compatible."""
         return self
 
     def __exit__(self, *_):
-        """Exit context manager function to unlink temp files."""
-        self.__unlink()
+        """Exit context manager function."""
 
     def __iter__(self):
         """Flush queued commands into a list and return an iterator for it."""
@@ -64,7 +59,6 @@ class CommandBuffer:
 
         buf = self.__buf
         self.__buf = []
-        self.__last_index = 0
 
         return buf
 
@@ -77,50 +71,13 @@ class CommandBuffer:
 
             self.__last_cmd = cmd
 
-    def __mkindex(self):
-        i = self.__last_index
-        self.__last_index += 1
-
-        return i
-
     def __handle_exec(self):
         self.__buf.append((CommandType.EXEC, self.__last_script_body))
 
         self.__last_script_body = ""
 
     def __handle_upload(self):
-        fileobj = NamedTemporaryFile(suffix=".tar.gz", prefix=__name__,
-                                     delete=False)
-
-        fileobj_name = os.path.basename(fileobj.name)
-        unpack_cmd = f"""\
-#!/bin/bash
-cd /tmp
-tar -xf '{fileobj_name}'
-rm -v '{fileobj_name}'
-"""
-
-        with tarfile.open(mode="w:gz", fileobj=fileobj) as tarobj:
-            for remote_path, local_path in self.__last_uploads:
-                local_name = os.path.basename(local_path)
-                arcname = f"{local_name}.{fileobj_name}{self.__mkindex()}"
-                unpack_cmd += f"""\
-mv -v '{arcname}' '{remote_path}'
-rm -v '{arcname}'
-"""
-
-                tarobj.add(local_path, arcname=arcname)
-
-        self.__files_to_unlink.append(fileobj.name)
-        self.__buf.append(CommandType.UPLOAD, f"/tmp/{fileobj_name}",
-                          fileobj.name)
+        for remote_path, local_path in self.__last_uploads:
+            self.__buf.append((CommandType.UPLOAD, remote_path, local_path))
 
         self.__last_uploads = []
-
-        self.add_exec(unpack_cmd)
-
-    def __unlink(self):
-        for filepath in self.__files_to_unlink:
-            os.unlink(filepath)
-
-        self.__files_to_unlink = []
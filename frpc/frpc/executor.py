@@ -1,39 +1,180 @@
-
 """Module containing base and utility classes for remote execution."""
 
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import math
 from multiprocessing.pool import ThreadPool
-from typing import List, Callable
+import queue
+import threading
+import time
+from typing import AsyncIterator, List, Callable
 from .interface import ExecutionResult, InterfaceFactory, Interface, \
-        InterfaceProgress
-
+        InterfaceProgress, run_blocking
+from . import metrics
+from .result_sink import ResultSink, collect_results
 
-# pylint: disable=invalid-name
 
 logger = logging.getLogger(__name__)
-_progress = None
 
 
 RemoteExecutor = Callable[[Interface], List[ExecutionResult]]
 
 
-def _run_init(prog):
-    global _progress  # pylint: disable=global-statement
+async def _call_async(executor: RemoteExecutor,
+                      interface: Interface) -> List[ExecutionResult]:
+    """Call `executor` natively if it supports coroutines.
+
+    Executors without `call_async()` are run in the default executor.
+    """
+    call_async = getattr(executor, "call_async", None)
+
+    if call_async is not None:
+        return await call_async(interface)
+
+    return await run_blocking(executor, interface)
+
+
+class ChunkScheduler:
+    """Thread-safe dispenser of MAC chunks for a pool of workers.
+
+    Workers take a new chunk as soon as they finish the previous one, so
+    a slow chunk doesn't hold back the rest of the list. Chunk size is
+    bounded by three rules:
+
+        - `remaining / (2 * workers)`, so chunks shrink towards the end of
+          the list and the last chunks finish at about the same time;
+        - `target_time / latency`, where latency is the observed per-device
+          time, so that a chunk takes about `target_time` seconds;
+        - [`min_size`; `max_size`].
+    """
+
+    # weight of the latest observation in the per-device latency average
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, macs: List[str], workers: int, min_size: int = 1,
+                 max_size: int = None, target_time: float = 60.):
+        """Class constructor.
+
+        Arguments:
+            macs: MAC list.
+            workers: number of workers that take chunks.
+            min_size: minimum chunk size.
+            max_size: maximum chunk size, unbounded if None.
+            target_time: desired time in seconds to process a chunk.
+        """
+        self.macs = macs
+        self.workers = workers
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_time = target_time
+        self.latency = None
+
+        self.__lock = threading.Lock()
+        self.__offset = 0
+        self.__chunks = 0
+
+    def next_chunk(self) -> List[str]:
+        """Take the next chunk, returns an empty list once all are taken."""
+        with self.__lock:
+            remaining = len(self.macs) - self.__offset
+
+            if remaining <= 0:
+                return []
+
+            size = self.__chunk_size(remaining)
+            chunk = self.macs[self.__offset: self.__offset + size]
+
+            self.__offset += size
+            self.__chunks += 1
+
+        logger.debug(f"chunk #{self.__chunks}: {len(chunk)} devices, \
+{remaining - len(chunk)} left")
 
-    _progress = prog
+        return chunk
 
+    def report(self, size: int, elapsed: float):
+        """Report the time in seconds it took to process a chunk of `size`."""
+        if size <= 0:
+            return
 
-def _run_executor(args):
-    executor, interface_factory, macs = args
+        latency = elapsed / size
 
-    with interface_factory(macs, progress=_progress) as interface:
-        return executor(interface)
+        with self.__lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+
+    def cancel(self):
+        """Stop handing out chunks."""
+        with self.__lock:
+            self.__offset = len(self.macs)
+
+    def __chunk_size(self, remaining: int) -> int:
+        size = math.ceil(remaining / (2 * self.workers))
+
+        if self.latency is not None and self.latency > 0:
+            size = min(size, math.ceil(self.target_time / self.latency))
+
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+
+        return min(max(size, self.min_size), remaining)
+
+
+def _min_batch_size(interface_factory: InterfaceFactory, batch_size: int,
+                    min_batch_size: int = None) -> int:
+    """Pick the minimum chunk size, it never exceeds `batch_size`."""
+    if min_batch_size is None:
+        interface_cls = getattr(interface_factory, "interface_cls", None)
+        min_batch_size = getattr(interface_cls, "MIN_PARTITION_SIZE", 1)
+
+    if batch_size is not None:
+        min_batch_size = min(min_batch_size, batch_size)
+
+    return min_batch_size
+
+
+def _report(scheduler: ChunkScheduler, size: int, elapsed: float):
+    """Feed the time it took to process a partition to scheduler/metrics."""
+    scheduler.report(size, elapsed)
+
+    metrics.observe("partition", elapsed)
+
+    if size > 0:
+        metrics.observe("device", elapsed / size, count=size)
+
+
+def _run_worker(args):
+    executor, interface_factory, scheduler, progress, output = args
+
+    try:
+        macs = scheduler.next_chunk()
+
+        while macs:
+            start = time.monotonic()
+
+            with interface_factory(macs, progress=progress) as interface:
+                results = executor(interface)
+
+            _report(scheduler, len(macs), time.monotonic() - start)
+            output.put(results)
+
+            macs = scheduler.next_chunk()
+    except Exception as err:  # pylint: disable=broad-except
+        scheduler.cancel()
+        output.put(err)
+    finally:
+        output.put(None)
 
 
 class ParallelExecutor:
-    """Class to partition a mac list and execute parallel commands on them."""
+    """Class to split a mac list and execute parallel commands on chunks.
+
+    See `ChunkScheduler` for the way the list is split.
+    """
 
     interface_factory: InterfaceFactory
     executor: RemoteExecutor
@@ -50,41 +191,183 @@ class ParallelExecutor:
                                                  an interface from a MAC list.
             executor: RemoteExecutor: an executor that accepts interface.
             processes: int = None: number of processes to spawn that will
-                                   execute remote commands on split partitions.
+                                   execute remote commands on chunks.
+            batch_size: int = None: maximum chunk size.
+            min_batch_size: int = None: minimum chunk size, the interface
+                                        `MIN_PARTITION_SIZE` if None.
+            chunk_time: float = 60: desired time in seconds to process
+                                    a chunk, see `ChunkScheduler`.
         """
         self.interface_factory = kwargs["interface_factory"]
         self.executor = kwargs["executor"]
         self.macs = macs
         self.processes = kwargs.get("processes")
-        self.batch_size = math.ceil(len(self.macs) / self.processes)
-
-        if self.batch_size < 2:
-            self.batch_size = 2
+        self.batch_size = kwargs.get("batch_size")
+        self.min_batch_size = _min_batch_size(
+                self.interface_factory, self.batch_size,
+                kwargs.get("min_batch_size"))
+        self.chunk_time = kwargs.get("chunk_time", 60.)
 
-            logger.warning(f"adjusted batch_size to {self.batch_size}, not \
-all threads will be utilized")
+        if len(self.macs) < self.processes * 2:
+            logger.warning(f"only {len(self.macs)} devices for \
+{self.processes} processes, not all threads will be utilized")
 
-        logger.debug(f"selected batch_size = {self.batch_size}")
+    def run(self, sink: ResultSink = None) -> List[ExecutionResult]:
+        """Split mac list and spawn workers for execution.
 
-    def run(self) -> List[ExecutionResult]:
-        """Partition mac list and spawn workers for execution."""
+        Arguments:
+            sink: if set, results of every chunk are pushed into it as
+                  soon as the chunk finishes and the returned results
+                  carry no stdout/stderr.
+        """
         results = []
         progress = InterfaceProgress(len(self.macs))
+        scheduler = ChunkScheduler(self.macs, self.processes,
+                                   min_size=self.min_batch_size,
+                                   max_size=self.batch_size,
+                                   target_time=self.chunk_time)
+        output = queue.Queue()
+
+        logger.debug(f"processing {len(self.macs)} devices in parallel \
+on {self.processes} processes")
+
+        with ThreadPool(processes=self.processes) as pool:
+            pool.map_async(_run_worker, [
+                (self.executor, self.interface_factory, scheduler, progress,
+                 output)
+                for _ in range(self.processes)
+                ])
+
+            running = self.processes
+
+            while running > 0:
+                item = output.get()
+
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    collect_results(results, item, sink)
+
+        return results
+
+
+class AsyncExecutor:
+    """Class to split a mac list and execute commands on an event loop.
+
+    Chunks are driven by coroutines on a single event loop instead of
+    a thread pool, so the number of chunks in flight is limited only
+    by `inflight`. See `ChunkScheduler` for the way the list is split.
+    """
+
+    interface_factory: InterfaceFactory
+    executor: RemoteExecutor
+    macs: List[str]
+    batch_size: int
+    inflight: int
+
+    def __init__(self, macs: List[str], **kwargs):
+        """Construct an executor that executes commands concurrently.
+
+        Arguments:
+            macs: MAC list.
+            interface_factory: InterfaceFactory: a factory that creates
+                                                 an interface from a MAC list.
+            executor: RemoteExecutor: an executor that accepts interface,
+                                      executors with a `call_async()`
+                                      coroutine are awaited natively.
+            inflight: int: maximum number of chunks in flight.
+            batch_size: int = None: maximum chunk size.
+            min_batch_size: int = None: minimum chunk size, the interface
+                                        `MIN_PARTITION_SIZE` if None.
+            chunk_time: float = 60: desired time in seconds to process
+                                    a chunk, see `ChunkScheduler`.
+        """
+        self.interface_factory = kwargs["interface_factory"]
+        self.executor = kwargs["executor"]
+        self.macs = macs
+        self.inflight = kwargs["inflight"]
+        self.batch_size = kwargs.get("batch_size")
+        self.min_batch_size = _min_batch_size(
+                self.interface_factory, self.batch_size,
+                kwargs.get("min_batch_size"))
+        self.chunk_time = kwargs.get("chunk_time", 60.)
+
+    def run(self, sink: ResultSink = None) -> List[ExecutionResult]:
+        """Split mac list and execute chunks on an event loop.
+
+        Arguments:
+            sink: see `ParallelExecutor.run()`.
+        """
+        return asyncio.run(self.__collect(sink))
+
+    async def iter_results(self) -> AsyncIterator[List[ExecutionResult]]:
+        """Execute chunks and yield their results as they complete."""
+        # blocking fallbacks (e.g. `requests`) share the in-flight limit
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(self.inflight))
+
+        progress = InterfaceProgress(len(self.macs))
+        scheduler = ChunkScheduler(self.macs, self.inflight,
+                                   min_size=self.min_batch_size,
+                                   max_size=self.batch_size,
+                                   target_time=self.chunk_time)
+        output = asyncio.Queue()
+
+        logger.debug(f"processing {len(self.macs)} devices with \
+up to {self.inflight} chunks in flight")
 
-        with ThreadPool(processes=self.processes, initializer=_run_init,
-                        initargs=(progress,)) as pool:
+        workers = [
+                loop.create_task(self.__run_worker(scheduler, progress,
+                                                   output))
+                for _ in range(self.inflight)
+                ]
 
-            partitions = [
-                    (self.executor,
-                     self.interface_factory,
-                     self.macs[i: i + self.batch_size])
-                    for i in range(0, len(self.macs), self.batch_size)
-                    ]
+        try:
+            running = len(workers)
 
-            logger.debug(f"processing {len(partitions)} partitions in \
-parallel on {self.processes} processes")
+            while running > 0:
+                item = await output.get()
+
+                if item is None:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def __collect(self, sink: ResultSink = None) \
+            -> List[ExecutionResult]:
+        results = []
 
-            for res in pool.imap_unordered(_run_executor, partitions):
-                results.extend(res)
+        async for chunk_results in self.iter_results():
+            collect_results(results, chunk_results, sink)
 
         return results
+
+    async def __run_worker(self, scheduler: ChunkScheduler,
+                           progress: InterfaceProgress,
+                           output: asyncio.Queue):
+        try:
+            macs = scheduler.next_chunk()
+
+            while macs:
+                start = time.monotonic()
+
+                async with self.interface_factory(
+                        macs, progress=progress) as interface:
+                    results = await _call_async(self.executor, interface)
+
+                _report(scheduler, len(macs), time.monotonic() - start)
+                output.put_nowait(results)
+
+                macs = scheduler.next_chunk()
+        except Exception as err:  # pylint: disable=broad-except
+            scheduler.cancel()
+            output.put_nowait(err)
+        finally:
+            output.put_nowait(None)
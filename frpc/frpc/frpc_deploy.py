@@ -2,11 +2,14 @@
 """Module describing program behaviour for pre- and post-deploy activities."""
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from enum import Enum, unique
 import functools
+import hashlib
 import json
 import logging
+import os
 from pathlib import Path
 from typing import Callable, Dict, List, NamedTuple, Iterator
 import time
@@ -15,6 +18,7 @@ from .argparse_type import frange, irange, filepath_type
 from .base_frpc import BaseFRPC
 from . import compute
 from . import executor
+from .macset import MacSet
 from .script_executor import ScriptExecutor
 from . import targeting
 
@@ -23,9 +27,20 @@ logger = logging.getLogger(__name__)
 
 
 class PersistentState(dict):
-    """Dictionary-based container that can persist on disk."""
+    """Dictionary-based container that can persist on disk.
+
+    The state is stored as a JSON snapshot plus an append-only journal of
+    changes made since the snapshot, so `save()` writes only the changes.
+    Top-level keys are journaled on assignment, nested values have to be
+    changed with `set_in()` and `extend_in()`. `compact()` folds the journal
+    into a new snapshot.
+    """
+
+    # compact once the journal outgrows both the limit and the snapshot
+    JOURNAL_SIZE_LIMIT = 1 << 20
 
     path: Path
+    journal_path: Path
 
     def __init__(self, path=None, path_generator=None):
         """Class constructor.
@@ -48,17 +63,44 @@ class PersistentState(dict):
                 i += 1
 
         self.path = path
+        self.journal_path = path.with_name(f"{path.name}.journal")
+
+        self.__pending: List[str] = []
+        self.__snapshot_digest = None
+        self.__snapshot_size = 0
 
         super().__init__(self._load())
 
+    def __setitem__(self, key, value):
+        """Set a top-level key and journal the change."""
+        super().__setitem__(key, value)
+        self.__record("set", [key], value)
+
+    def set_in(self, keys: List[str], value):
+        """Set a nested value, e.g. `state[keys[0]][keys[1]] = value`."""
+        self.__lookup(self, keys[:-1])[keys[-1]] = value
+        self.__record("set", keys, value)
+
+    def extend_in(self, keys: List[str], items: List):
+        """Extend a nested list, e.g. `state[keys[0]].extend(items)`."""
+        if not items:
+            return
+
+        self.__lookup(self, keys).extend(items)
+        self.__record("extend", keys, items)
+
     def _load(self):
         if self.path.exists():
             try:
-                with self.path.open() as state_file:
-                    state = json.load(state_file)
+                data = self.path.read_bytes()
+                state = json.loads(data)
 
                 logger.info(f"recovering from a state file {self.path}")
 
+                self.__snapshot_digest = hashlib.sha256(data).hexdigest()
+                self.__snapshot_size = len(data)
+                self.__replay(state)
+
                 return state
             except OSError:
                 logger.exception("failed to open existing state file")
@@ -70,12 +112,47 @@ class PersistentState(dict):
         return {}
 
     def save(self):
-        """Save the current state into the file."""
+        """Save changes made since the last save."""
+        if self.__snapshot_digest is None or \
+                not self.journal_path.exists():
+            self.compact()
+
+            return
+
+        if not self.__pending:
+            return
+
+        try:
+            with self.journal_path.open("a") as journal_file:
+                journal_file.writelines(self.__pending)
+                size = journal_file.tell()
+
+            self.__pending = []
+        except OSError:
+            logger.exception("failed to write a state journal")
+            logger.critical("proceeding without a state backup isn't safe")
+
+            return
+
+        if size > max(self.JOURNAL_SIZE_LIMIT, self.__snapshot_size):
+            self.compact()
+
+    def compact(self):
+        """Save the whole state into the file and start a new journal."""
         try:
             state_exists = self.path.exists()
+            data = json.dumps(self, indent=4).encode()
+            digest = hashlib.sha256(data).hexdigest()
 
-            with self.path.open("w") as state_file:
-                json.dump(self, state_file, indent=4)
+            self.__write_atomic(self.path, data)
+            # the journal is tied to the snapshot, a stale one is ignored
+            self.__write_atomic(self.journal_path, (json.dumps({
+                "snapshot": digest,
+                }) + "\n").encode())
+
+            self.__snapshot_digest = digest
+            self.__snapshot_size = len(data)
+            self.__pending = []
 
             if not state_exists:
                 logger.info(f"created a new state file {self.path}")
@@ -83,6 +160,84 @@ class PersistentState(dict):
             logger.exception("failed to create a state file")
             logger.critical("proceeding without a state backup isn't safe")
 
+    def close(self):
+        """Fold the journal into the snapshot on exit.
+
+        Unsaved changes are dropped, like after a crash, so the snapshot
+        alone holds the saved state and can be edited by hand.
+        """
+        if self.__pending:
+            logger.debug("dropping unsaved state changes")
+
+            super().clear()
+            super().update(self._load())
+
+        self.compact()
+
+    def __record(self, operation: str, keys: List[str], value):
+        # serialize right away, `value` may be changed in place later
+        self.__pending.append(json.dumps([operation, keys, value]) + "\n")
+
+    def __replay(self, state: dict):
+        try:
+            with self.journal_path.open() as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return
+
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, json.JSONDecodeError):
+            header = {}
+
+        if header.get("snapshot") != self.__snapshot_digest:
+            logger.warning(f"ignoring stale state journal \
+{self.journal_path}")
+
+            return
+
+        for i, line in enumerate(lines[1:], 2):
+            try:
+                operation, keys, value = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be torn by a crash in the middle of save
+                if i == len(lines):
+                    logger.warning(f"ignoring a partial record at the end \
+of {self.journal_path}")
+
+                    # don't append after it, compact on the next save
+                    self.__snapshot_digest = None
+
+                    break
+
+                raise
+
+            container = self.__lookup(state, keys[:-1])
+
+            if operation == "set":
+                container[keys[-1]] = value
+            elif operation == "extend":
+                container[keys[-1]].extend(value)
+            else:
+                raise ValueError(f"unknown journal operation `{operation}`")
+
+        if len(lines) > 1:
+            logger.info(f"replayed {len(lines) - 1} state journal records")
+
+    @staticmethod
+    def __lookup(container, keys: List[str]):
+        for key in keys:
+            container = container[key]
+
+        return container
+
+    @staticmethod
+    def __write_atomic(path: Path, data: bytes):
+        tmp_path = path.with_name(f"{path.name}.tmp")
+
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
 
 @unique
 class DeployType(Enum):
@@ -100,7 +255,7 @@ class TargetAction(NamedTuple):
     """Fix pumps based on sumo query."""
 
     name: str
-    fetch_macs: Callable[[], List[str]]
+    fetch_macs: Callable[[], MacSet]
     mk_executor: Callable[[], executor.RemoteExecutor]
 
 
@@ -108,20 +263,24 @@ class Generator:
     """Base generator class."""
 
     state: PersistentState
+    device_registry: MacSet
 
-    def __init__(self, state: PersistentState, predeploy: bool = True):
+    def __init__(self, state: PersistentState, device_registry: MacSet,
+                 predeploy: bool = True):
         """Construct a generator. Every generator should call this.
 
         Arguments:
             state: state dictionary from `FRPCDeploy` class.
+            device_registry: MACs to generate lists from.
             predeploy: determines `_have_time()` behaviour,
                        if it's not a pre-deploy we always have time.
         """
         self.state = state
+        self.device_registry = device_registry
         self.predeploy = predeploy
 
-    def __call__(self) -> Iterator[List[str]]:
-        """Generate MACs lists."""
+    def __call__(self) -> Iterator[numpy.ndarray]:
+        """Generate MACs arrays."""
 
     def wait(self):
         """Time list generator."""
@@ -148,26 +307,24 @@ class OTDeployGenerator(Generator):
     BUCKETS = 16384
     START_TIME_KEY = "ot_deploy_generator_start_time"
 
-    buckets: List[List[str]]
     cutoff: int
 
-    def __init__(self, state: PersistentState, predeploy: bool = True):
+    def __init__(self, state: PersistentState, device_registry: MacSet,
+                 predeploy: bool = True):
         """Prepare bucket lists."""
-        super().__init__(state, predeploy)
+        super().__init__(state, device_registry, predeploy)
 
         logger.info(
                 f"prepairing {self.BUCKETS} buckets for overtime deploy")
 
-        self.buckets = [[] for _ in range(self.BUCKETS)]
+        buckets = device_registry.values % numpy.uint64(self.BUCKETS)
+        # group MACs by bucket, keeping them sorted within a bucket
+        order = numpy.argsort(buckets, kind="stable")
+        self.__macs = device_registry.values[order]
+        self.__bounds = numpy.searchsorted(buckets[order],
+                                           numpy.arange(self.BUCKETS + 1))
 
-        for mac in state["device_registry"]:
-            bucket = int(mac, 16) % self.BUCKETS
-
-            self.buckets[bucket].append(mac)
-
-        lengths = numpy.array([
-            len(bucket) for bucket in self.buckets
-            ])
+        lengths = numpy.diff(self.__bounds)
 
         logger.info(f"bucket length max = {lengths.max()}, \
 min = {lengths.min()}, std = {lengths.std():.2f}")
@@ -175,8 +332,12 @@ min = {lengths.min()}, std = {lengths.std():.2f}")
         self.__start_time_key = self.START_TIME_KEY + \
             ("_predeploy" if predeploy else "_postdeploy")
 
-    def __call__(self) -> Iterator[List[str]]:
-        """Mac lists generator."""
+    def bucket(self, index: int) -> numpy.ndarray:
+        """Return MACs of a bucket."""
+        return self.__macs[self.__bounds[index]:self.__bounds[index + 1]]
+
+    def __call__(self) -> Iterator[numpy.ndarray]:
+        """Mac arrays generator."""
         if self.__start_time_key not in self.state:
             self.state[self.__start_time_key] = time.time()
 
@@ -187,7 +348,7 @@ min = {lengths.min()}, std = {lengths.std():.2f}")
             if not self._have_time(server_time):
                 return
 
-            yield self.buckets[cutoff]
+            yield self.bucket(cutoff)
 
     def wait(self):
         """List generation timing."""
@@ -208,37 +369,41 @@ min = {lengths.min()}, std = {lengths.std():.2f}")
 class ImmediateDeployGenerator(Generator):
     """MAC lists generator for PTG deploy (simply returns the full list)."""
 
-    def __call__(self) -> Iterator[List[str]]:
-        """Return full MAC list."""
+    def __call__(self) -> Iterator[numpy.ndarray]:
+        """Return full MAC array."""
         if not self._have_time(self.state["start_time"]):
             return
 
-        yield self.state["device_registry"]
+        yield self.device_registry.values
 
 
 def resize_generator(generator: Generator, min_size: int,
-                     offset: int = None) -> Iterator[List]:
-    """Resize lists generated by `generator` to lists of `min_size`."""
-    chunk = []
+                     offset: int = None) -> Iterator[numpy.ndarray]:
+    """Resize arrays generated by `generator` to arrays of `min_size`.
 
-    for item in generator():
-        chunk.extend(item)
+    The first `offset` items are skipped.
+    """
+    chunks = []
+    size = 0
 
-        if offset is not None:
-            if len(chunk) <= offset:
-                continue
+    for item in generator():
+        if offset:
+            skip = min(offset, len(item))
+            item = item[skip:]
+            offset -= skip
 
-            chunk = chunk[offset:]
-            offset = None
+        chunks.append(item)
+        size += len(item)
 
-        if len(chunk) >= min_size:
+        if size >= min_size:
             generator.wait()
-            yield chunk
-            chunk = []
+            yield numpy.concatenate(chunks)
+            chunks = []
+            size = 0
 
-    if len(chunk) > 0:
+    if size > 0:
         generator.wait()
-        yield chunk
+        yield numpy.concatenate(chunks)
 
 
 def _mk_se_creator(name: str) -> Callable[[], ScriptExecutor]:
@@ -264,26 +429,77 @@ class DeployActivity:
         self.state = state
         self.name = name
 
-        self.__state = state.get(name, {})
-        state[name] = self.__state
+        if name not in state:
+            state[name] = {"offset": 0}
 
-        if "offset" not in self.__state:
-            self.__state["offset"] = 0
+        self.__state = state[name]
+        self.__targets: Dict[str, MacSet] = {}
 
     def fetch_targets(self):
-        """Fetch MAC lists for target actions."""
-        targets = self.__state.get("targets", {})
-        failed_targets = self.__state.get("failed_targets", {})
+        """Fetch MAC lists for target actions.
+
+        Targets missing from the state are fetched concurrently, so sumo
+        queries and the boson scan overlap and the whole step takes as
+        long as the slowest of them. Fetched targets are saved even if
+        another one fails.
+
+        Also builds a membership index of every target list, so batches
+        are matched against the targets without rehashing them.
+
+        Throws:
+            The first error raised by a target action's `fetch_macs`.
+        """
+        for key in ("targets", "failed_targets"):
+            if key not in self.__state:
+                self.state.set_in([self.name, key], {})
+
+        self.__targets = {}
+
+        missing = [
+                target_action
+                for target_action in self.target_actions
+                if target_action.name not in self.__state["targets"]
+                ]
+        futures = {}
+        error = None
+
+        if missing:
+            logger.info(f"fetching {len(missing)} {self.name} targets")
+
+            with ThreadPoolExecutor(len(missing),
+                                    thread_name_prefix="fetch-targets") \
+                    as pool:
+                for target_action in missing:
+                    futures[target_action.name] = \
+                            pool.submit(target_action.fetch_macs)
 
         for target_action in self.target_actions:
-            if target_action.name not in targets:
-                targets[target_action.name] = target_action.fetch_macs()
+            name = target_action.name
+
+            if name in self.__state["targets"]:
+                self.__targets[name] = targeting.fix_macs(
+                        self.__state["targets"][name])
+            else:
+                try:
+                    macs = futures[name].result()
+                # incl. `SystemExit` of a `logger.critical()` in a fetcher
+                except BaseException as err:  # pylint: disable=broad-except
+                    error = error or err
+
+                    continue
 
-            if target_action.name not in failed_targets:
-                failed_targets[target_action.name] = []
+                self.state.set_in([self.name, "targets", name],
+                                  macs.to_strings())
+                self.__targets[name] = macs
 
-        self.__state["targets"] = targets
-        self.__state["failed_targets"] = failed_targets
+            if name not in self.__state["failed_targets"]:
+                self.state.set_in([self.name, "failed_targets", name], [])
+
+        if error is not None:
+            # keep the fetched targets, the caller won't save the state
+            self.state.save()
+
+            raise error
 
     def mk_executors(self) -> Dict[str, executor.RemoteExecutor]:
         """Create executors for target actions."""
@@ -313,26 +529,27 @@ class DeployActivity:
         executors = self.mk_executors()
 
         failed = 0
-        total = len(self.state["device_registry"])
+        total = len(mac_lists_generator.device_registry)
 
         self.state.save()
 
-        for macs in resize_generator(mac_lists_generator,
-                                     self.state["batch_size"],
-                                     offset=self.__state["offset"]):
+        for batch in resize_generator(mac_lists_generator,
+                                      self.state["batch_size"],
+                                      offset=self.__state["offset"]):
             for action_name, action_executor in executors.items():
-                action_macs = targeting.device_registry_select(
-                        self.__state["targets"][action_name], macs)
+                action_macs = MacSet(
+                        batch[self.__targets[action_name].contains(batch)])
 
-                results = macs_executor(action_macs, action_name,
-                                        action_executor)
+                results = macs_executor(action_macs.to_strings(),
+                                        action_name, action_executor)
 
-                for result in results:
-                    if not result.success:
-                        self.__state["failed_targets"][action_name] \
-                            .append(result.mac)
+                self.state.extend_in(
+                        [self.name, "failed_targets", action_name],
+                        [result.mac for result in results
+                         if not result.success])
 
-            self.__state["offset"] += len(macs)
+            self.state.set_in([self.name, "offset"],
+                              self.__state["offset"] + len(batch))
 
             failed = sum([
                 len(macs) for macs in self.__state["failed_targets"].values()
@@ -366,11 +583,14 @@ credentials so MAKE SURE to configure those beforehand.
 """
 
     state: PersistentState
+    device_registry: MacSet
     dr_targeting: targeting.DeviceRegistryTargeting
-    mac_lists_generator: Callable[[], Iterator[List[str]]]
+    mac_lists_generator: Callable[..., Generator]
     predeploy_activity: DeployActivity
     postdeploy_activity: DeployActivity
 
+    DEVICE_REGISTRY_SIDECAR = "device-registry-{digest}.npy"
+
     __wait_offset: float = 0.
 
     def __init__(self):
@@ -394,6 +614,7 @@ For PTG/ETG deploy this should a .csv file")
         self._argparser_add_boson()
         self._argparser_add_rpc()
         self._argparser_add_exec()
+        self._argparser_add_sumo()
 
         self.argparser.add_argument("--state-file", type=Path, help="\
 File to save to or load current state from")
@@ -441,8 +662,9 @@ to get from a device to SumoLogic")
 
         try:
             self.dr_targeting = targeting.DeviceRegistryTargeting(
-                    self.state["device_registry"],
-                    boson_factory=self.create_boson_factory())
+                    self.device_registry,
+                    boson_factory=self.create_boson_factory(),
+                    sumo_cache=self.create_sumo_cache())
         except targeting.SumoConfigError:
             logger.exception(
                     f"no valid config in `{targeting.SUMO_DEFAULT_CONFIG}`")
@@ -488,7 +710,7 @@ to get from a device to SumoLogic")
         logger.info(f"executing a {self.state['deploy_type']} deploy")
 
         logger.info(f"\
-device registry contains {len(self.state['device_registry'])} MACs")
+device registry contains {len(self.device_registry)} MACs")
 
         if self.state["deploy_type"] == DeployType.FULL.name:
             logger.info(f"span time is {self.state['span_time']} minutes")
@@ -499,26 +721,33 @@ pre-deploy activities")
 
             return
 
-        self.interface_factory = self.create_rpc_factory()
+        try:
+            self.interface_factory = self.create_rpc_factory()
 
-        self.predeploy_activity.exec(self.mac_lists_generator(self.state),
-                                     self._exec_macs)
+            self.predeploy_activity.exec(
+                    self.mac_lists_generator(self.state, self.device_registry),
+                    self._exec_macs)
 
-        self.__wait(0, "the deploy to begin")
+            self.__wait(0, "the deploy to begin")
 
-        if self.state["deploy_type"] == DeployType.FULL.name:
-            self.__wait(self.state["span_time"] * 60,
-                        "the overtime deploy to finish")
+            if self.state["deploy_type"] == DeployType.FULL.name:
+                self.__wait(self.state["span_time"] * 60,
+                            "the overtime deploy to finish")
 
-        self.__wait(self.state["install_time"], "the binaries to be installed")
-        self.__wait(self.state["sumo_delay"], "the sumo logs to be populated")
+            self.__wait(self.state["install_time"],
+                        "the binaries to be installed")
+            self.__wait(self.state["sumo_delay"],
+                        "the sumo logs to be populated")
 
-        self.postdeploy_activity.exec(
-                self.mac_lists_generator(self.state, predeploy=False),
-                self._exec_macs)
+            self.postdeploy_activity.exec(
+                    self.mac_lists_generator(self.state, self.device_registry,
+                                             predeploy=False),
+                    self._exec_macs)
 
-        self.state["finished"] = True
-        self.state.save()
+            self.state["finished"] = True
+            self.state.save()
+        finally:
+            self.state.close()
 
     def _generate_state_path(self, suffix):
         dtstr = datetime.now(tz=timezone.utc).strftime("%y%m%d%H%M")
@@ -532,14 +761,14 @@ state-file-{self.args.deploy_type}-deploy-{dtstr}{suffix}.json")
                                      path_generator=self._generate_state_path)
 
         self._args_populate_state(self.state)
-        self.state.save()  # Test if we have the write permissions
+        # start with a fresh journal, also tests the write permissions
+        self.state.compact()
 
     def _args_populate_state(self, state: PersistentState):
         args = self.args
         args_state = {
                 "deploy_type": args.deploy_type.name,
                 "span_time": args.span_time,
-                "device_registry": self._args_load_device_registry(),
                 "batch_size": args.batch_size,
                 "start_time": args.start_time,
                 "safety_time_buffer": args.safety_time_buffer,
@@ -553,7 +782,20 @@ state-file-{self.args.deploy_type}-deploy-{dtstr}{suffix}.json")
             if key not in state:
                 state[key] = value
 
-        if len(self.state["device_registry"]) <= 0:
+        registry = state.get("device_registry")
+
+        if registry is None:
+            self.device_registry = self._args_load_device_registry()
+            state["device_registry"] = self._store_device_registry()
+        elif isinstance(registry, list):
+            # older state files keep the registry as a list of MACs
+            self.device_registry = targeting.fix_macs(registry)
+            state["device_registry"] = self._store_device_registry()
+            self.__reset_legacy_offsets(state)
+        else:
+            self.device_registry = self._load_device_registry(registry)
+
+        if len(self.device_registry) <= 0:
             logger.critical("device registry is empty")
 
         if self.state["deploy_type"] == DeployType.FULL.name:
@@ -565,7 +807,22 @@ state-file-{self.args.deploy_type}-deploy-{dtstr}{suffix}.json")
         else:
             raise NotImplementedError("No args validation for the deploy type")
 
-    def _args_load_device_registry(self):
+    @staticmethod
+    def __reset_legacy_offsets(state: PersistentState):
+        # offsets of a list registry index its file order, the migrated
+        # registry is sorted, so the progress can't be mapped onto it
+        for name in ("predeploy_activity", "postdeploy_activity"):
+            activity = state.get(name)
+
+            if activity is None or activity.get("offset", 0) <= 0:
+                continue
+
+            logger.warning(f"{name} progress of {activity['offset']} devices \
+can't be resumed after the device registry migration, starting it over")
+
+            state.set_in([name, "offset"], 0)
+
+    def _args_load_device_registry(self) -> MacSet:
         try:
             return {
                     DeployType.FULL: targeting.load_dg_device_registry,
@@ -580,6 +837,43 @@ state-file-{self.args.deploy_type}-deploy-{dtstr}{suffix}.json")
 
         return None
 
+    def _store_device_registry(self) -> Dict:
+        """Save the registry next to the state file, return a reference."""
+        digest = self.device_registry.digest()
+        path = self.state.path.with_name(
+                self.DEVICE_REGISTRY_SIDECAR.format(digest=digest))
+
+        try:
+            if not path.exists():
+                self.device_registry.save(path)
+
+                logger.info(f"saved device registry into {path}")
+        except OSError:
+            logger.exception("failed to save device registry")
+            logger.critical("proceeding without a state backup isn't safe")
+
+        return {
+                "file": path.name,
+                "sha256": digest,
+                "size": len(self.device_registry),
+                }
+
+    def _load_device_registry(self, registry: Dict) -> MacSet:
+        """Map the registry file referenced by the state."""
+        path = self.state.path.with_name(registry["file"])
+
+        try:
+            device_registry = MacSet.load(path)
+        except (OSError, ValueError):
+            logger.exception(f"failed to load device registry from {path}")
+            logger.critical("couldn't recover previous state")
+
+        if device_registry.digest() != registry["sha256"]:
+            logger.critical(f"device registry {path} doesn't match \
+the state file")
+
+        return device_registry
+
     def _exec_macs(self, macs: List[str], suffix: str,
                    remote_exec: executor.RemoteExecutor):
         self.macs = macs
@@ -2,11 +2,14 @@
 """Module for the base interface class."""
 
 from abc import ABC, abstractmethod
+import asyncio
+import functools
 import logging
 from typing import List, NamedTuple
 from threading import Lock
 from .command import CommandBuffer
 from . import compute
+from . import metrics
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +23,15 @@ class ExecutionResult(NamedTuple):
     success: bool
     stdout: str
     stderr: str
+    attempts: int = 1
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking callable in the default executor of the running loop."""
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
 
 
 class InterfaceError(Exception):
@@ -67,6 +79,11 @@ class InterfaceProgress:
 class Interface(ABC):
     """Base interface class, every RPC interface should inherit this."""
 
+    # prefix of the phases recorded with `_timer()`
+    METRICS_PREFIX = "interface"
+    # default lower bound of a partition size, see `ChunkScheduler`
+    MIN_PARTITION_SIZE = 1
+
     def __init__(self, macs: List[str], progress: InterfaceProgress = None):
         """Base class constructor.
 
@@ -80,7 +97,8 @@ class Interface(ABC):
 
     def __enter__(self):
         """Context manager entrance point."""
-        self.open()
+        with self._timer("open"):
+            self.open()
 
         return self
 
@@ -88,6 +106,17 @@ class Interface(ABC):
         """Context manager exit point."""
         self.close()
 
+    async def __aenter__(self):
+        """Asynchronous context manager entrance point."""
+        with self._timer("open"):
+            await self.open_async()
+
+        return self
+
+    async def __aexit__(self, *_):
+        """Asynchronous context manager exit point."""
+        await self.close_async()
+
     @abstractmethod
     def open(self):
         """Open a connection over the interface."""
@@ -107,6 +136,31 @@ executing anything")
         """Return list of active devices in `self.mac`."""
         raise NotImplementedError("method not implemented")
 
+    async def open_async(self):
+        """Open a connection over the interface from a coroutine.
+
+        Interfaces with native coroutine support should override this,
+        the default implementation runs `open()` in the default executor.
+        """
+        await run_blocking(self.open)
+
+    async def close_async(self):
+        """Close the connection over the interface from a coroutine."""
+        await run_blocking(self.close)
+
+    async def execute_async(self, command_buffer: CommandBuffer) \
+            -> List[ExecutionResult]:
+        """Execute the list of commands stored in the command_buffer.
+
+        Interfaces with native coroutine support should override this,
+        the default implementation runs `execute()` in the default executor.
+        """
+        return await run_blocking(self.execute, command_buffer)
+
+    def _timer(self, phase: str):
+        """Time an interface `phase`, see `metrics.timer()`."""
+        return metrics.timer(f"{self.METRICS_PREFIX}_{phase}")
+
     def _progress(self, increment: int):
         current = self.__progress.update(increment)
         total = self.__progress.total
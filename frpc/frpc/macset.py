@@ -0,0 +1,298 @@
+"""Compact set of MAC addresses backed by a sorted NumPy array."""
+
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import numpy
+
+
+MAC_LENGTH = 12
+
+_HEX_DIGITS = numpy.frombuffer(b"0123456789abcdef", dtype=numpy.uint8)
+# flags every byte that is a hex digit
+_IS_HEX = numpy.zeros(256, dtype=bool)
+_IS_HEX[numpy.frombuffer(b"0123456789abcdefABCDEF", dtype=numpy.uint8)] = \
+    True
+# value of every hex digit byte
+_HEX_VALUES = numpy.zeros(256, dtype=numpy.uint64)
+_HEX_VALUES[numpy.frombuffer(b"0123456789abcdef", dtype=numpy.uint8)] = \
+    numpy.arange(16)
+_HEX_VALUES[numpy.frombuffer(b"ABCDEF", dtype=numpy.uint8)] = \
+    numpy.arange(10, 16)
+# bit offsets of every MAC digit, most significant first
+_SHIFTS = numpy.arange(4 * (MAC_LENGTH - 1), -1, -4, dtype=numpy.uint64)
+
+
+def parse_macs(macs: Iterable[str]) -> numpy.ndarray:
+    """Convert MAC strings into an unsorted array of integers.
+
+    Throws:
+        ValueError: one of the macs has invalid format.
+    """
+    if not isinstance(macs, list):
+        macs = list(macs)
+
+    lengths = numpy.fromiter(map(len, macs), dtype=numpy.int64,
+                             count=len(macs))
+    invalid = numpy.flatnonzero(lengths != MAC_LENGTH)
+
+    if len(invalid) > 0:
+        raise ValueError(f"mac `{macs[invalid[0]]}` length has to be \
+{MAC_LENGTH}")
+
+    text = "".join(macs)
+    # non-ASCII characters become a single "?" and fail the check below
+    codes = numpy.frombuffer(text.encode("ascii", "replace"),
+                             dtype=numpy.uint8)
+    invalid = numpy.flatnonzero(~_IS_HEX[codes])
+
+    if len(invalid) > 0:
+        raise ValueError(f"mac `{macs[invalid[0] // MAC_LENGTH]}` has \
+invalid format")
+
+    # big-endian 6-byte MACs padded to 8 bytes
+    octets = numpy.zeros((len(macs), 8), dtype=numpy.uint8)
+    octets[:, 2:] = numpy.frombuffer(bytes.fromhex(text), dtype=numpy.uint8) \
+        .reshape(-1, 6)
+
+    return octets.view(">u8").ravel().astype(numpy.uint64)
+
+
+def parse_ascii(codes: numpy.ndarray) -> numpy.ndarray:
+    """Convert an (N, 12) array of ASCII bytes into an array of integers.
+
+    Throws:
+        ValueError: one of the rows has a byte that isn't a hex digit.
+    """
+    invalid = numpy.flatnonzero(~_IS_HEX[codes].all(axis=1))
+
+    if len(invalid) > 0:
+        mac = codes[invalid[0]].tobytes().decode("ascii", "replace")
+
+        raise ValueError(f"mac `{mac}` has invalid format")
+
+    return (_HEX_VALUES[codes] << _SHIFTS).sum(axis=1, dtype=numpy.uint64)
+
+
+def prefix_range(prefix: str) -> Tuple[int, int]:
+    """Return the [low, high) range of MACs starting with a hex `prefix`.
+
+    Throws:
+        ValueError: `prefix` is not a hex string.
+    """
+    if len(prefix) > MAC_LENGTH:
+        raise ValueError(f"prefix `{prefix}` is longer than a mac")
+
+    shift = 4 * (MAC_LENGTH - len(prefix))
+    low = int(prefix, 16) << shift if prefix else 0
+
+    return low, low + (1 << shift)
+
+
+def unique(values: numpy.ndarray) -> numpy.ndarray:
+    """Sort `values` and drop duplicates."""
+    values = numpy.sort(numpy.asarray(values, dtype=numpy.uint64))
+
+    if len(values) == 0:
+        return values
+
+    mask = numpy.empty(len(values), dtype=bool)
+    mask[0] = True
+    numpy.not_equal(values[1:], values[:-1], out=mask[1:])
+
+    return values[mask]
+
+
+def format_macs(values: numpy.ndarray) -> List[str]:
+    """Convert an array of integers into lowercase MAC strings."""
+    if len(values) == 0:
+        return []
+
+    digits = (numpy.asarray(values, dtype=numpy.uint64)[:, None] >> _SHIFTS) \
+        & numpy.uint64(0xf)
+
+    return _HEX_DIGITS[digits].view(f"S{MAC_LENGTH}").ravel() \
+        .astype(numpy.str_).tolist()
+
+
+class MacSet:
+    """Immutable set of MAC addresses.
+
+    MACs are stored as a sorted array of unique 48-bit integers, so set
+    operations are vectorized and a million MACs take 8MB. Iterating
+    the set yields lowercase MAC strings in ascending order.
+    """
+
+    __slots__ = ("__values",)
+
+    def __init__(self, values: numpy.ndarray = None, presorted: bool = False):
+        """Class constructor.
+
+        Arguments:
+            values: array of MACs as integers.
+            presorted: `values` are already sorted and unique.
+        """
+        if values is None:
+            values = numpy.empty(0, dtype=numpy.uint64)
+        elif not presorted:
+            values = unique(values)
+
+        self.__values = values
+
+    @classmethod
+    def from_strings(cls, macs: Iterable[str]) -> "MacSet":
+        """Parse MAC strings, duplicates are dropped.
+
+        Throws:
+            ValueError: one of the macs has invalid format.
+        """
+        return cls(parse_macs(macs))
+
+    @classmethod
+    def from_text(cls, text: str) -> "MacSet":
+        """Parse whitespace-separated MAC strings.
+
+        Throws:
+            ValueError: one of the macs has invalid format.
+        """
+        return cls.from_strings(text.split())
+
+    @classmethod
+    def coerce(cls, macs: Union["MacSet", Iterable[str]]) -> "MacSet":
+        """Return `macs` if it's a `MacSet`, parse it otherwise.
+
+        Throws:
+            ValueError: one of the macs has invalid format.
+        """
+        if isinstance(macs, cls):
+            return macs
+
+        return cls.from_strings(macs)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "MacSet":
+        """Load a set saved with `save()`.
+
+        Arguments:
+            path: `.npy` file path.
+            mmap: map the file into memory instead of reading it.
+
+        Throws:
+            OSError: failed to read the file.
+            ValueError: the file doesn't contain a MAC array.
+        """
+        values = numpy.load(path, mmap_mode="r" if mmap else None,
+                            allow_pickle=False)
+
+        if values.dtype != numpy.uint64 or values.ndim != 1:
+            raise ValueError(f"`{path}` doesn't contain a mac array")
+
+        return cls(values, presorted=True)
+
+    def save(self, path: Path):
+        """Save the set into a `.npy` file that `load()` can map.
+
+        Throws:
+            OSError: failed to write the file.
+        """
+        # concurrent writers of the same file don't share a temp file
+        with tempfile.NamedTemporaryFile(dir=Path(path).parent,
+                                         prefix=f"{Path(path).name}.",
+                                         suffix=".tmp",
+                                         delete=False) as npy_file:
+            numpy.save(npy_file, self.__values, allow_pickle=False)
+
+        os.replace(npy_file.name, path)
+
+    def digest(self) -> str:
+        """Return SHA-256 of the set contents."""
+        return hashlib.sha256(
+                numpy.ascontiguousarray(self.__values, dtype="<u8")) \
+            .hexdigest()
+
+    @property
+    def values(self) -> numpy.ndarray:
+        """Sorted array of MACs as integers, shouldn't be modified."""
+        return self.__values
+
+    def to_strings(self) -> List[str]:
+        """Convert into a sorted list of lowercase MAC strings."""
+        return format_macs(self.__values)
+
+    def contains(self, values: numpy.ndarray) -> numpy.ndarray:
+        """Return a boolean mask of integer `values` that are in the set.
+
+        Takes O(len(values) * log(len(self))), the set isn't copied.
+        """
+        values = numpy.asarray(values, dtype=numpy.uint64)
+
+        if len(self.__values) == 0:
+            return numpy.zeros(len(values), dtype=bool)
+
+        index = numpy.searchsorted(self.__values, values)
+        index[index == len(self.__values)] = 0
+
+        return self.__values[index] == values
+
+    def isin(self, other: "MacSet") -> numpy.ndarray:
+        """Return a boolean mask of MACs that are also in `other`."""
+        return other.contains(self.__values)
+
+    def with_prefix(self, prefix: str) -> "MacSet":
+        """Select MACs starting with a hex `prefix`.
+
+        Throws:
+            ValueError: `prefix` is not a hex string.
+        """
+        bounds = numpy.array(prefix_range(prefix), dtype=numpy.uint64)
+        start, end = numpy.searchsorted(self.__values, bounds)
+
+        return MacSet(self.__values[start:end], presorted=True)
+
+    def __and__(self, other: "MacSet") -> "MacSet":
+        """Intersection."""
+        return MacSet(numpy.intersect1d(self.__values, other.values,
+                                        assume_unique=True),
+                      presorted=True)
+
+    def __or__(self, other: "MacSet") -> "MacSet":
+        """Union."""
+        return MacSet(numpy.concatenate((self.__values, other.values)))
+
+    def __sub__(self, other: "MacSet") -> "MacSet":
+        """Difference."""
+        return MacSet(numpy.setdiff1d(self.__values, other.values,
+                                      assume_unique=True),
+                      presorted=True)
+
+    def __contains__(self, mac: Union[str, int]) -> bool:
+        """Check membership of a MAC string or integer."""
+        if isinstance(mac, str):
+            try:
+                mac = int(parse_macs([mac])[0])
+            except ValueError:
+                return False
+
+        return bool(self.contains([mac])[0])
+
+    def __eq__(self, other) -> bool:
+        """Compare with another `MacSet`."""
+        if not isinstance(other, MacSet):
+            return NotImplemented
+
+        return numpy.array_equal(self.__values, other.values)
+
+    def __len__(self) -> int:
+        """Return the number of MACs."""
+        return len(self.__values)
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over MAC strings in ascending order."""
+        return iter(self.to_strings())
+
+    def __repr__(self) -> str:
+        """Return a short description."""
+        return f"<MacSet of {len(self)} macs>"
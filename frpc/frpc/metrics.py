@@ -0,0 +1,257 @@
+"""Per-phase timing metrics of frpc executions.
+
+Phases are timed with `timer()` (or `observe()` for durations measured
+elsewhere) into the process-wide `METRICS` registry, which aggregates them
+into histograms and can be dumped as a Prometheus textfile or a JSON
+summary, either once or periodically with `PeriodicDump`.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterator, List, Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+# upper bounds in seconds, from a single ssh round-trip to a whole partition
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.,
+                   10., 30., 60., 120., 300., 600., 1800., math.inf)
+
+PROMETHEUS_METRIC = "frpc_phase_duration_seconds"
+
+METRICS_FORMATS = ("prometheus", "json")
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations, not thread-safe."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """Class constructor.
+
+        Arguments:
+            buckets: sorted bucket upper bounds, the last one must be `inf`.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float, count: int = 1):
+        """Add `count` observations of `value`."""
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += count
+                break
+
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[int]:
+        """Return cumulative bucket counts, as in Prometheus `le` buckets."""
+        result = []
+        total = 0
+
+        for count in self.counts:
+            total += count
+            result.append(total)
+
+        return result
+
+    def quantile(self, q: float) -> float:
+        """Estimate the `q` quantile by interpolating inside its bucket."""
+        if self.count == 0:
+            return math.nan
+
+        rank = q * self.count
+        lower = 0.
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            if count > 0 and total + count >= rank:
+                upper = min(bound, self.max)
+                lower = max(lower, self.min)
+
+                return lower + (upper - lower) * (rank - total) / count
+
+            total += count
+            lower = bound
+
+        return self.max
+
+    def summary(self) -> dict:
+        """Return a JSON-serializable summary."""
+        if self.count == 0:
+            return {"count": 0}
+
+        return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count,
+                "min": self.min,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                }
+
+
+class Metrics:
+    """Thread-safe registry of phase duration histograms."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """Class constructor.
+
+        Arguments:
+            buckets: see `Histogram`.
+        """
+        self.buckets = buckets
+        self.__lock = threading.Lock()
+        self.__histograms: Dict[str, Histogram] = {}
+
+    def observe(self, phase: str, seconds: float, count: int = 1):
+        """Record `count` durations of `seconds` for `phase`."""
+        with self.__lock:
+            histogram = self.__histograms.get(phase)
+
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self.__histograms[phase] = histogram
+
+            histogram.observe(seconds, count)
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        """Context manager that records the duration of its body.
+
+        Works inside coroutines as well, the duration then includes the time
+        the coroutine was suspended.
+        """
+        start = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start)
+
+    def reset(self):
+        """Drop all observations."""
+        with self.__lock:
+            self.__histograms = {}
+
+    def to_json(self) -> dict:
+        """Return a JSON-serializable summary of every phase."""
+        with self.__lock:
+            return {
+                    phase: histogram.summary()
+                    for phase, histogram in sorted(self.__histograms.items())
+                    }
+
+    def to_prometheus(self) -> str:
+        """Return histograms in the Prometheus text exposition format."""
+        lines = [
+                f"# HELP {PROMETHEUS_METRIC} \
+Duration of frpc execution phases.",
+                f"# TYPE {PROMETHEUS_METRIC} histogram",
+                ]
+
+        with self.__lock:
+            for phase, histogram in sorted(self.__histograms.items()):
+                labels = f'phase="{phase}"'
+
+                for bound, count in zip(histogram.buckets,
+                                        histogram.cumulative()):
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+
+                    lines.append(f'{PROMETHEUS_METRIC}_bucket\
+{{{labels},le="{le}"}} {count}')
+
+                lines.append(f"{PROMETHEUS_METRIC}_sum{{{labels}}} \
+{histogram.sum!r}")
+                lines.append(f"{PROMETHEUS_METRIC}_count{{{labels}}} \
+{histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: Path, fmt: str = None):
+        """Atomically write metrics into `path`.
+
+        Arguments:
+            path: output file, e.g. in the node exporter textfile directory.
+            fmt: one of `METRICS_FORMATS`, JSON for a `.json` `path` and
+                 Prometheus otherwise if None.
+
+        Throws:
+            OSError: failed to write the file.
+        """
+        if fmt is None:
+            fmt = "json" if path.suffix.lower() == ".json" else "prometheus"
+
+        if fmt == "json":
+            text = json.dumps(self.to_json(), indent=4) + "\n"
+        else:
+            text = self.to_prometheus()
+
+        # the textfile collector may read the file at any moment
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(text)
+        os.replace(tmp_path, path)
+
+        logger.debug(f"dumped metrics into `{path}`")
+
+
+class PeriodicDump:
+    """Background thread that dumps metrics every `period` seconds."""
+
+    def __init__(self, metrics: Metrics, path: Path, period: float,
+                 fmt: str = None):
+        """Class constructor, see `Metrics.dump()` for the arguments."""
+        self.metrics = metrics
+        self.path = path
+        self.period = period
+        self.fmt = fmt
+
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True,
+                                         name="metrics-dump")
+
+    def start(self):
+        """Start dumping."""
+        self.__thread.start()
+
+    def stop(self):
+        """Stop dumping and wait for the thread to exit."""
+        self.__stop.set()
+
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def __run(self):
+        while not self.__stop.wait(self.period):
+            try:
+                self.metrics.dump(self.path, self.fmt)
+            except OSError as err:
+                logger.warning(f"failed to dump metrics: {err}")
+
+
+METRICS = Metrics()
+
+
+def timer(phase: str):
+    """Time `phase` into the process-wide registry, see `Metrics.timer()`."""
+    return METRICS.timer(phase)
+
+
+def observe(phase: str, seconds: float, count: int = 1):
+    """Record `phase` into the process-wide registry."""
+    METRICS.observe(phase, seconds, count)
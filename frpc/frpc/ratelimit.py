@@ -1,47 +1,122 @@
-
 """Helper classes and function related to ratelimiting."""
 
+import asyncio
 import logging
 import time
 import threading
+from typing import Dict, Hashable
 
 
 logger = logging.getLogger(__name__)
 
 
-class Ratelimit:
-    """Class for ratelimiting actions with `time.sleep()`."""
+class TokenBucket:
+    """Thread-safe token bucket ratelimit.
 
-    def __init__(self, period: float):
+    The bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second. Every action takes a token. When the bucket is empty, the token
+    is reserved in advance and the caller sleeps until it's due, so waiting
+    callers are served in order without holding the lock while they sleep.
+    Use it either as a (async) context manager or with `acquire()` and
+    `acquire_async()`.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
         """Class constructor.
 
         Arguments:
-            period: minimal allowed period (in seconds) between two requests.
+            rate: number of tokens added per second.
+            burst: bucket capacity, i.e. the number of actions allowed
+                   back to back after a period of inactivity.
         """
-        self.period = period
+        self.rate = rate
+        self.burst = burst
         self.__lock = threading.Lock()
-        self.__last_mono = time.monotonic() - period
+        self.__tokens = burst
+        self.__last_mono = time.monotonic()
+
+    def acquire(self, tokens: float = 1):
+        """Take `tokens`, sleep until they are available."""
+        delay = self._reserve(tokens)
+
+        if delay > 0:
+            logger.debug(f"delay action for {delay:.3f}s")
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens: float = 1):
+        """Take `tokens`, await until they are available."""
+        delay = self._reserve(tokens)
+
+        if delay > 0:
+            logger.debug(f"delay action for {delay:.3f}s")
+            await asyncio.sleep(delay)
 
-    def _ratelimit(self):
+    def _reserve(self, tokens: float) -> float:
+        """Take `tokens` and return the time to wait until they are due."""
         with self.__lock:
             mono = time.monotonic()
-            diff = mono - self.__last_mono
+            self.__tokens = min(self.burst, self.__tokens +
+                                (mono - self.__last_mono) * self.rate)
+            self.__last_mono = mono
+            self.__tokens -= tokens
 
-            if self.period > diff:
-                delay = self.period - diff
+            if self.__tokens >= 0:
+                return 0.
 
-                logger.debug(f"delay action for {delay:.3f}s")
-                time.sleep(delay)
-
-                self.__last_mono = time.monotonic()
-            else:
-                self.__last_mono = mono
+            return -self.__tokens / self.rate
 
     def __enter__(self):
         """Context manager entrance point."""
-        self._ratelimit()
+        self.acquire()
 
         return self
 
     def __exit__(self, *_):
         """Context manager exit point."""
+
+    async def __aenter__(self):
+        """Asynchronous context manager entrance point."""
+        await self.acquire_async()
+
+        return self
+
+    async def __aexit__(self, *_):
+        """Asynchronous context manager exit point."""
+
+
+class Ratelimit(TokenBucket):
+    """Class for ratelimiting actions with a minimal period between them."""
+
+    def __init__(self, period: float):
+        """Class constructor.
+
+        Arguments:
+            period: minimal allowed period (in seconds) between two requests.
+        """
+        super().__init__(1 / period)
+
+        self.period = period
+
+
+class KeyedRatelimit:
+    """Independent token buckets keyed by e.g. host or environment name."""
+
+    def __init__(self, rate: float, burst: float = 1):
+        """Class constructor.
+
+        Arguments:
+            rate: see `TokenBucket`, same for every bucket.
+            burst: see `TokenBucket`, same for every bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.__lock = threading.Lock()
+        self.__buckets: Dict[Hashable, TokenBucket] = {}
+
+    def __getitem__(self, key: Hashable) -> TokenBucket:
+        """Return the bucket for `key`, create it if necessary."""
+        with self.__lock:
+            if key not in self.__buckets:
+                self.__buckets[key] = TokenBucket(self.rate, self.burst)
+
+            return self.__buckets[key]
@@ -0,0 +1,183 @@
+"""Streaming sinks that persist execution results as they arrive."""
+
+from abc import ABC, abstractmethod
+import csv
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterable, List, Type
+from .interface import ExecutionResult
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultSink(ABC):
+    """Base class for an append-only, crash-safe execution results file.
+
+    Rows are written as soon as they are pushed, the file is flushed and
+    fsync'ed every `fsync_rows` rows or `fsync_period` seconds, whichever
+    comes first, and on `close()`.
+    """
+
+    def __init__(self, path: Path, fsync_rows: int = 1000,
+                 fsync_period: float = 5.):
+        """Open `path` for appending.
+
+        Arguments:
+            path: output file path.
+            fsync_rows: maximum number of rows written between two fsyncs.
+            fsync_period: maximum time in seconds between two fsyncs.
+
+        Throws:
+            OSError: failed to open `path`.
+            ValueError: `path` has contents the sink can't append to.
+        """
+        self.path = path
+        self.fsync_rows = fsync_rows
+        self.fsync_period = fsync_period
+        self.count = 0
+
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__last_sync = time.monotonic()
+
+        is_new = not path.exists() or path.stat().st_size == 0
+
+        if not is_new:
+            self._check_existing()
+
+        logger.info(f"{'writing' if is_new else 'APPENDING'} \
+execution results to `{path}`")
+
+        self._file = path.open(mode="a", newline="")
+        self._open(is_new)
+
+    def __enter__(self):
+        """Context manager entrance point."""
+        return self
+
+    def __exit__(self, *_):
+        """Context manager exit point."""
+        self.close()
+
+    def push(self, results: Iterable[ExecutionResult]):
+        """Write `results` into the sink."""
+        with self.__lock:
+            for result in results:
+                self._write(result)
+                self.__pending += 1
+                self.count += 1
+
+            if self.__pending >= self.fsync_rows or \
+                    time.monotonic() - self.__last_sync >= self.fsync_period:
+                self.__sync()
+
+    def close(self):
+        """Sync and close the output file."""
+        with self.__lock:
+            if self._file.closed:
+                return
+
+            self.__sync()
+            self._file.close()
+
+        logger.info(f"done writing {self.count} entries")
+
+    def _check_existing(self):
+        """Make sure results can be appended to the existing `self.path`.
+
+        Throws:
+            ValueError: they can't.
+        """
+
+    def _open(self, is_new: bool):
+        """Prepare a freshly opened file, e.g. write a header."""
+
+    @abstractmethod
+    def _write(self, result: ExecutionResult):
+        """Serialize a single result into `self._file`."""
+        raise NotImplementedError("Implement result serialization here")
+
+    def __sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self.__pending = 0
+        self.__last_sync = time.monotonic()
+
+
+class CsvResultSink(ResultSink):
+    """Execution results sink in CSV format."""
+
+    def _check_existing(self):
+        with self.path.open(newline="") as fileobj:
+            header = next(csv.reader(fileobj, dialect=csv.unix_dialect), [])
+
+        if header != list(ExecutionResult._fields):
+            raise ValueError(f"`{self.path}` has columns {header}, \
+expected {list(ExecutionResult._fields)}, use another file")
+
+    def _open(self, is_new: bool):
+        self.__writer = csv.DictWriter(self._file,
+                                       fieldnames=ExecutionResult._fields,
+                                       dialect=csv.unix_dialect)
+
+        if is_new:
+            self.__writer.writeheader()
+
+    def _write(self, result: ExecutionResult):
+        self.__writer.writerow(result._asdict())
+
+
+class JsonlResultSink(ResultSink):
+    """Execution results sink in JSON lines format."""
+
+    def _write(self, result: ExecutionResult):
+        self._file.write(json.dumps(result._asdict()) + "\n")
+
+
+SINK_FORMATS: Dict[str, Type[ResultSink]] = {
+        "csv": CsvResultSink,
+        "jsonl": JsonlResultSink,
+        }
+
+
+def create_sink(path: Path, fmt: str = None, **kwargs) -> ResultSink:
+    """Create a result sink for `path`.
+
+    Arguments:
+        path: output file path.
+        fmt: one of `SINK_FORMATS`, guessed from the `path` suffix if None.
+
+        See `ResultSink` for the rest of the arguments.
+    """
+    if fmt is None:
+        fmt = path.suffix.lstrip(".").lower()
+
+        if fmt not in SINK_FORMATS:
+            fmt = "csv"
+
+    return SINK_FORMATS[fmt](path, **kwargs)
+
+
+def strip_output(result: ExecutionResult) -> ExecutionResult:
+    """Drop stdout and stderr of a result that has already been persisted."""
+    return result._replace(stdout=None, stderr=None)
+
+
+def collect_results(results: List[ExecutionResult],
+                    partition_results: List[ExecutionResult],
+                    sink: ResultSink = None):
+    """Add `partition_results` to `results`, persisting them into `sink`.
+
+    Results pushed into `sink` are kept without stdout and stderr.
+    """
+    if sink is None:
+        results.extend(partition_results)
+    else:
+        sink.push(partition_results)
+        results.extend(map(strip_output, partition_results))
@@ -1,13 +1,19 @@
 
 """Module for the rpc interface class."""
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import json
 import logging
 from os import path
 from pathlib import Path
+import random
 import threading
-from typing import List, NamedTuple
+import time
+from typing import Any, Callable, List, NamedTuple, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
 
 try:
     from simplejson import JSONDecodeError
@@ -16,6 +22,8 @@ except ImportError:
 
 from .command import CommandBuffer, CommandType
 from . import interface
+from . import metrics
+from .ratelimit import KeyedRatelimit
 
 
 logger = logging.getLogger(__name__)
@@ -126,80 +134,112 @@ def _redact_dict(target, level=10):
     return target_copy
 
 
+class RetryPolicy(NamedTuple):
+    """Retry policy for transient OPS failures.
+
+    Connection errors, timeouts, 5xx and 429 responses are retried up to
+    `retries` times with full jitter exponential backoff, i.e. a random
+    delay in [0; min(`max_backoff`, `backoff` * 2 ** attempt)) seconds,
+    unless the response has a `Retry-After` header.
+    """
+
+    retries: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 30.
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Return the delay in seconds before retrying a failed `attempt`."""
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+
+        return random.uniform(
+                0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class RPCRequestError(requests.RequestException):
+    """OPS request failed permanently or ran out of retries."""
+
+    def __init__(self, err: requests.RequestException, attempts: int):
+        """Wrap the last error of a request that took `attempts` attempts."""
+        super().__init__(f"{err} (attempts: {attempts})",
+                         response=getattr(err, "response", None))
+
+        self.attempts = attempts
+
+
+def _is_transient(err: requests.RequestException) -> bool:
+    if isinstance(err, (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError)):
+        return True
+
+    if err.response is None:
+        return False
+
+    return err.response.status_code == 429 or \
+        err.response.status_code >= 500
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    value = None if response is None \
+        else response.headers.get("Retry-After")
+
+    if value is None:
+        return None
+
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0., (date - datetime.now(timezone.utc)).total_seconds())
+
+
 class RPCInterface(interface.Interface):
     """OPS RPC interface implementation."""
 
+    METRICS_PREFIX = "rpc"
+    # every partition opens its own session and keep-alive connections
+    MIN_PARTITION_SIZE = 4
+
     __cache: dict = {}  # using `NamedTuple.__hash__()` as hash
     __cache_cv = threading.Condition()
 
     def __init__(self, macs: List[str], ops_creds: OPSCredentials,
-                 *args, **kwargs):
+                 *args, ratelimit: KeyedRatelimit = None,
+                 inflight: int = 1, retry: RetryPolicy = RetryPolicy(),
+                 **kwargs):
         """RPC interface constructor.
 
         Arguments:
             macs: pump MACs to connect to.
             ops_creds: credentials for the OPS portal.
+            ratelimit: OPS requests ratelimit, keyed by environment name.
+            inflight: maximum number of concurrent OPS requests.
+            retry: retry policy for transient OPS failures.
         """
         super().__init__(macs, *args, **kwargs)
 
         self.__creds = ops_creds
+        self.__ratelimit = None if ratelimit is None \
+            else ratelimit[ops_creds.env]
         self.__access_token = None
+        self.inflight = inflight
+        self.retry = retry
         self.__session = requests.Session()
 
+        # keep-alive connections for every request in flight
+        adapter = HTTPAdapter(pool_maxsize=inflight, pool_block=True)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+
     def open(self):
         """Get access token for further OPS requests."""
-        with self.__cache_cv:
-            # producer is already up
-            if self.__creds in self.__cache:
-                self.__cache_cv.wait_for(
-                        lambda: self.__creds in self.__cache and
-                        self.__cache[self.__creds] is not None)
-
-                if self.__creds in self.__cache:
-                    logger.debug(f"got cached access token for \
-{self.__creds.login}")
-
-                    self.__access_token = self.__cache[self.__creds]
-                else:
-                    logger.debug("producer thread failed, becoming one")
-
-                    self.__cache[self.__creds] = None
-            else:
-                logger.debug("we are the first thread, becoming a producer")
-
-                self.__cache[self.__creds] = None
-
-        if self.__cache[self.__creds] is None:
-            # we are the producer
-            request_body = {
-                    "login": self.__creds.login,
-                    "password": self.__creds.password,
-                    }
-
-            logger.debug(f"\
-attempting to authenticate as {self.__creds.login} @ {self.__creds.env}")
-
-            try:
-                response = self.__put("authenticate",
-                                      params={"details": True},
-                                      json=request_body)
-
-                self.__access_token = response["access_token"]
-
-                logger.info(f"authenticated as {self.__creds.login}")
-
-                with self.__cache_cv:
-                    self.__cache[self.__creds] = self.__access_token
-                    self.__cache_cv.notify_all()
-            except (requests.RequestException, KeyError) as err:
-                logger.error(f"network failure has occured: {err}")
-
-                with self.__cache_cv:
-                    del self.__cache[self.__creds]
-                    self.__cache_cv.notify()
-
-                raise interface.FatalInterfaceError("network failure") from err
-
+        self.__access_token = self.__authenticate()
         self.is_open = True
 
     def execute(self, command_buffer: CommandBuffer) \
@@ -209,28 +249,57 @@ attempting to authenticate as {self.__creds.login} @ {self.__creds.env}")
             raise RuntimeError("An interface should be opened before \
 executing anything")
 
-        commands = command_buffer.flush()
+        commands = [
+                command_args[0]
+                for command_type, *command_args in command_buffer.flush()
+                if command_type is CommandType.EXEC
+                ]
+
+        if self.inflight <= 1:
+            return [
+                    result
+                    for mac in self.macs
+                    for result in self.__exec_mac(mac, commands)
+                    ]
+
+        # devices are processed concurrently, commands of a single device
+        # are still sent in order, results are ordered as `self.macs`
+        with ThreadPoolExecutor(max_workers=self.inflight) as pool:
+            futures = [
+                    pool.submit(self.__exec_mac, mac, commands)
+                    for mac in self.macs
+                    ]
+
+            return [
+                    result
+                    for future in futures
+                    for result in future.result()
+                    ]
+
+    def __exec_mac(self, mac: str, commands: List[str]) \
+            -> List[interface.ExecutionResult]:
         results = []
+        start = time.monotonic()
 
-        for mac in self.macs:
-            for command_type, *command_args in commands:
-                if command_type is CommandType.EXEC:
-                    try:
-                        self.__send_rpc(mac, command_args[0])
+        for command in commands:
+            try:
+                attempts = self.__send_rpc(mac, command)
 
-                        success = True
-                    except requests.RequestException:
-                        logger.exception("rpc request failed")
+                success = True
+            except RPCRequestError as err:
+                logger.error(f"rpc request failed: {err}")
 
-                        success = False
+                attempts = err.attempts
+                success = False
 
-                    result = interface.ExecutionResult(
-                            mac=mac, returncode=None, success=success,
-                            stdout=None, stderr=None)
+            result = interface.ExecutionResult(
+                    mac=mac, returncode=None, success=success,
+                    stdout=None, stderr=None, attempts=attempts)
 
-                    results.append(result)
+            results.append(result)
 
-            self._progress(1)
+        metrics.observe("rpc_device", time.monotonic() - start)
+        self._progress(1)
 
         return results
 
@@ -240,10 +309,15 @@ executing anything")
     def __request(self, func, endpoint: str, **kwargs):
         url = self.__mkresturl(endpoint)
 
+        if self.__ratelimit is not None:
+            with self._timer("ratelimit"):
+                self.__ratelimit.acquire()
+
         logger.debug(f"\
 {func} request to {url}, kwargs = {_redact_dict(kwargs)}")
 
-        response = func(url, **kwargs)
+        with self._timer("request"):
+            response = func(url, **kwargs)
 
         try:
             response_json = response.json()
@@ -254,6 +328,9 @@ response json = `{_redact_dict(response_json)}`")
             logger.debug(f"reponse code = `{response.status_code}`, \
 response text = `{response.text}`")
 
+            # e.g. an HTML error page from a proxy, report the status first
+            response.raise_for_status()
+
             raise err
 
         response.raise_for_status()
@@ -266,15 +343,134 @@ response text = `{response.text}`")
     def __post(self, endpoint: str, **kwargs):
         return self.__request(self.__session.post, endpoint, **kwargs)
 
-    def __send_rpc(self, mac, command):
+    def __send_rpc(self, mac, command) -> int:
         request_body = {
                 "macAddress": mac,
                 "unixCommand": command,
                 }
 
-        return self.__post("deviceRPC",
-                           params={"access_token": self.__access_token},
-                           json=request_body)
+        _, attempts = self.__retry(lambda: self.__post(
+            "deviceRPC", params={"access_token": self.__access_token},
+            json=request_body))
+
+        return attempts
+
+    def __authenticate(self, expired: str = None) -> str:
+        """Return an access token, shared by interfaces with same creds.
+
+        The first thread to get here becomes the producer and authenticates,
+        the rest wait for it. If `expired` is the cached token, it's dropped
+        and the caller becomes a producer of a new one.
+        """
+        with self.__cache_cv:
+            if expired is not None and \
+                    self.__cache.get(self.__creds) == expired:
+                logger.info(f"access token for {self.__creds.login} \
+has expired")
+
+                del self.__cache[self.__creds]
+
+            # producer is already up
+            if self.__creds in self.__cache:
+                self.__cache_cv.wait_for(
+                        lambda: self.__creds not in self.__cache or
+                        self.__cache[self.__creds] is not None)
+
+                if self.__creds in self.__cache:
+                    logger.debug(f"got cached access token for \
+{self.__creds.login}")
+
+                    return self.__cache[self.__creds]
+
+                logger.debug("producer thread failed, becoming one")
+            else:
+                logger.debug("we are the first thread, becoming a producer")
+
+            self.__cache[self.__creds] = None
+
+        # we are the producer
+        request_body = {
+                "login": self.__creds.login,
+                "password": self.__creds.password,
+                }
+
+        logger.debug(f"\
+attempting to authenticate as {self.__creds.login} @ {self.__creds.env}")
+
+        try:
+            with self._timer("authenticate"):
+                response, _ = self.__retry(
+                        lambda: self.__put("authenticate",
+                                           params={"details": True},
+                                           json=request_body),
+                        reauth=False)
+
+            access_token = response["access_token"]
+        except (requests.RequestException, KeyError) as err:
+            logger.error(f"network failure has occured: {err}")
+
+            with self.__cache_cv:
+                del self.__cache[self.__creds]
+                self.__cache_cv.notify_all()
+
+            raise interface.FatalInterfaceError("network failure") from err
+
+        logger.info(f"authenticated as {self.__creds.login}")
+
+        with self.__cache_cv:
+            self.__cache[self.__creds] = access_token
+            self.__cache_cv.notify_all()
+
+        return access_token
+
+    def __retry(self, request: Callable[[], Any], reauth: bool = True) \
+            -> Tuple[Any, int]:
+        """Call `request` until it succeeds or fails permanently.
+
+        A 401 response is retried once with a fresh access token if `reauth`
+        is set, that retry doesn't count against `self.retry`. Transient
+        failures are retried according to `self.retry`.
+
+        Returns:
+            request result and the number of attempts it took.
+
+        Throws:
+            RPCRequestError: permanent failure, out of retries or failed to
+                             re-authenticate.
+        """
+        attempt = 1
+        retries = 0
+
+        while True:
+            access_token = self.__access_token
+
+            try:
+                return request(), attempt
+            except requests.RequestException as err:
+                if reauth and err.response is not None and \
+                        err.response.status_code == 401:
+                    try:
+                        self.__access_token = self.__authenticate(
+                                expired=access_token)
+                    except interface.FatalInterfaceError as auth_err:
+                        raise RPCRequestError(err, attempt) from auth_err
+
+                    reauth = False
+                    delay = 0.
+                elif _is_transient(err) and retries < self.retry.retries:
+                    retries += 1
+                    delay = self.retry.delay(retries,
+                                             _retry_after(err.response))
+                else:
+                    raise RPCRequestError(err, attempt) from err
+
+                logger.warning(f"\
+OPS request attempt #{attempt} failed: {err}, retrying in {delay:.2f}s")
+
+            with self._timer("backoff"):
+                time.sleep(delay)
+
+            attempt += 1
 
 
 class RPCInterfaceFactory(interface.InterfaceFactory):
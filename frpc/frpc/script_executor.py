@@ -43,11 +43,21 @@ class ScriptExecutor:
     def __call__(self, interface) -> List[ExecutionResult]:
         """Execute `script_bodies` on an interface."""
         with CommandBuffer() as buf:
-            for script_body in self.script_bodies:
-                buf.add_exec(script_body)
+            self.__fill(buf)
 
             return interface.execute(buf)
 
+    async def call_async(self, interface) -> List[ExecutionResult]:
+        """Execute `script_bodies` on an interface from a coroutine."""
+        with CommandBuffer() as buf:
+            self.__fill(buf)
+
+            return await interface.execute_async(buf)
+
+    def __fill(self, buf: CommandBuffer):
+        for script_body in self.script_bodies:
+            buf.add_exec(script_body)
+
     @classmethod
     def get_script_body(cls, script: str):
         """Return script body that corresponds to `script`.
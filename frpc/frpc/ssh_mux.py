@@ -0,0 +1,140 @@
+"""Persistent, multiplexed ssh master connections."""
+
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Dict
+from .ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class SSHMultiplexer:
+    """Keeps one multiplexed ssh master connection per host.
+
+    Masters live for the lifetime of the process and are shut down at exit.
+    Commands built with `ssh_command()` and `scp_command()` reuse the master
+    of their host. `connect()` checks that the master is alive and restarts
+    it if it died, so commands keep going through the ratelimited masters.
+    Commands use `ControlMaster=no`: if a master refuses a session (e.g.
+    sshd `MaxSessions`) ssh falls back to a regular connection instead of
+    failing the command, but never becomes a master itself.
+    """
+
+    def __init__(self, ratelimit: TokenBucket = None, timeout: float = 15):
+        """Class constructor.
+
+        Arguments:
+            ratelimit: ratelimit to apply to new master connections.
+            timeout: timeout in seconds for a master to connect.
+        """
+        self.ratelimit = ratelimit
+        self.timeout = timeout
+
+        self.__lock = threading.Lock()
+        self.__host_locks: Dict[str, threading.Lock] = {}
+        self.__masters = set()
+        self.__control_dir = None
+
+    def ssh_command(self, host: str) -> str:
+        """Return an ssh command prefix that goes through the `host` master."""
+        return f"ssh {self.__options(host)}"
+
+    def scp_command(self, host: str) -> str:
+        """Return an scp command prefix that goes through the `host` master."""
+        return f"scp {self.__options(host)}"
+
+    def connect(self, host: str):
+        """Start a master connection to `host` unless a live one exists.
+
+        Throws:
+            subprocess.CalledProcessError: ssh failed to connect.
+            subprocess.TimeoutExpired: ssh didn't connect in time.
+        """
+        with self.__host_lock(host):
+            if host in self.__masters:
+                if self.__check(host):
+                    return
+
+                logger.warning(f"ssh master for {host} is gone, reconnecting")
+
+                with self.__lock:
+                    self.__masters.discard(host)
+
+            cmd = f"ssh -o ControlMaster=yes -o ControlPersist=yes \
+-o ControlPath={self.control_path(host)} -f -N {host}"
+
+            if self.ratelimit is not None:
+                with self.ratelimit:
+                    self.__run(cmd)
+            else:
+                self.__run(cmd)
+
+            with self.__lock:
+                self.__masters.add(host)
+
+            logger.debug(f"started ssh master for {host}")
+
+    def close(self):
+        """Shut down all master connections."""
+        with self.__lock:
+            masters = list(self.__masters)
+            self.__masters = set()
+
+        for host in masters:
+            subprocess.run(
+                    f"ssh -o ControlPath={self.control_path(host)} \
+-O exit {host}",
+                    shell=True, check=False, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            logger.debug(f"stopped ssh master for {host}")
+
+        if self.__control_dir is not None:
+            shutil.rmtree(self.__control_dir, ignore_errors=True)
+            self.__control_dir = None
+
+    def control_path(self, host: str) -> str:
+        """Return the control socket path for `host`."""
+        with self.__lock:
+            if self.__control_dir is None:
+                self.__control_dir = tempfile.mkdtemp(prefix="frpc-ssh-")
+                atexit.register(self.close)
+
+        return os.path.join(self.__control_dir, host)
+
+    def __options(self, host: str) -> str:
+        control_path = self.control_path(host)
+
+        return f"-o ControlMaster=no -o ControlPath={control_path}"
+
+    def __host_lock(self, host: str) -> threading.Lock:
+        with self.__lock:
+            return self.__host_locks.setdefault(host, threading.Lock())
+
+    def __check(self, host: str) -> bool:
+        # asks the local master process, doesn't touch the network
+        try:
+            cproc = subprocess.run(
+                    f"ssh -o ControlPath={self.control_path(host)} \
+-O check {host}",
+                    shell=True, check=False, timeout=self.timeout,
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            return False
+
+        return cproc.returncode == 0
+
+    def __run(self, cmd: str):
+        logger.debug(f"running shell command `{cmd}`")
+
+        # the master daemonizes and keeps its std streams,
+        # capturing them would block until the master exits
+        subprocess.run(cmd, shell=True, check=True, timeout=self.timeout,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
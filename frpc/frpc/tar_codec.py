@@ -0,0 +1,174 @@
+"""Compression codecs for archives sent to remote hosts."""
+
+import gzip
+import logging
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, NamedTuple, Tuple
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# smaller archives are sent uncompressed with the "auto" codec
+AUTO_MIN_SIZE = 64 * 1024
+
+
+def _compress_none(data: bytes, _: int = None) -> bytes:
+    return data
+
+
+def _compress_gzip(data: bytes, level: int = None) -> bytes:
+    return gzip.compress(data, compresslevel=6 if level is None else level)
+
+
+def _compress_lz4(data: bytes, level: int = None) -> bytes:
+    return lz4.frame.compress(data, compression_level=level or 0)
+
+
+def _compress_zstd(data: bytes, level: int = None) -> bytes:
+    return zstandard.ZstdCompressor(level=3 if level is None else level) \
+        .compress(data)
+
+
+class Codec(NamedTuple):
+    """Archive compression codec."""
+
+    name: str
+    # remote shell command that extracts the archive from stdin
+    extract_cmd: str
+    # remote tool the codec depends on, None if tar handles it
+    remote_tool: str
+    compress: Callable[[bytes, int], bytes]
+    # supported [min; max] compression levels, None if there are none
+    levels: Tuple[int, int] = None
+
+    @property
+    def available(self) -> bool:
+        """Whether the python module the codec needs is installed."""
+        return {"lz4": lz4, "zstd": zstandard}.get(self.name, True) \
+            is not None
+
+    def clamp_level(self, level: int) -> int:
+        """Fit a compression `level` into the codec's range.
+
+        Lets the "auto" codec choice fall back to a codec that supports
+        fewer levels than the requested one. None stays None.
+        """
+        if level is None or self.levels is None:
+            return level
+
+        clamped = min(max(level, self.levels[0]), self.levels[1])
+
+        if clamped != level:
+            logger.debug(f"{self.name} doesn't support compression level \
+{level}, using {clamped}")
+
+        return clamped
+
+
+CODECS: Dict[str, Codec] = {
+        "none": Codec("none", "tar -x", None, _compress_none),
+        "gzip": Codec("gzip", "tar -xz", None, _compress_gzip, (0, 9)),
+        "lz4": Codec("lz4", "lz4 -dc | tar -x", "lz4", _compress_lz4,
+                     (0, 16)),
+        "zstd": Codec("zstd", "zstd -dc | tar -x", "zstd", _compress_zstd,
+                      (1, 22)),
+        }
+
+CODEC_CHOICES = ["auto", *CODECS]
+
+# preferred codecs for large archives, fastest first
+FAST_CODECS = ("zstd", "lz4")
+
+
+class RemoteTools:
+    """Thread-safe cache of compression tools available on remote hosts."""
+
+    def __init__(self):
+        """Class constructor."""
+        self.__lock = threading.Lock()
+        self.__host_locks: Dict[str, threading.Lock] = {}
+        self.__tools: Dict[str, FrozenSet[str]] = {}
+
+    def get(self, host: str,
+            probe: Callable[[], Iterable[str]]) -> FrozenSet[str]:
+        """Return tools available on `host`, call `probe` once per host.
+
+        A failed probe is treated as no tools available.
+        """
+        with self.__lock:
+            lock = self.__host_locks.setdefault(host, threading.Lock())
+
+        with lock:
+            tools = self.__tools.get(host)
+
+            if tools is None:
+                try:
+                    tools = frozenset(probe())
+                except Exception as err:  # pylint: disable=broad-except
+                    logger.warning(f"failed to probe codecs on {host}: {err}")
+
+                    tools = frozenset()
+
+                logger.debug(f"{host} supports {sorted(tools)} codecs")
+
+                self.__tools[host] = tools
+
+            return tools
+
+    @staticmethod
+    def probe_cmd() -> str:
+        """Return a remote shell command that prints the available tools."""
+        tools = " ".join(
+                codec.remote_tool
+                for codec in CODECS.values()
+                if codec.remote_tool is not None
+                )
+
+        return f"for tool in {tools}; do \
+command -v $tool >/dev/null && echo $tool; done; true"
+
+
+def select_codec(preference: str, size: int,
+                 remote_tools: Callable[[], FrozenSet[str]]) -> Codec:
+    """Pick a codec for an archive of `size` bytes.
+
+    Arguments:
+        preference: one of `CODEC_CHOICES`. "auto" sends small archives
+                    uncompressed and large ones with the fastest codec
+                    both sides support. Unsupported codecs fall back to gzip.
+        size: uncompressed archive size.
+        remote_tools: callable that returns tools available on the remote
+                      host, only called when the choice depends on them.
+    """
+    if preference == "auto":
+        if size < AUTO_MIN_SIZE:
+            return CODECS["none"]
+
+        candidates = FAST_CODECS
+    else:
+        candidates = (preference,)
+
+    for name in candidates:
+        codec = CODECS[name]
+
+        if not codec.available:
+            continue
+
+        if codec.remote_tool is None or codec.remote_tool in remote_tools():
+            return codec
+
+    if preference != "auto":
+        logger.debug(f"codec {preference} is not supported, using gzip")
+
+    return CODECS["gzip"]
@@ -1,27 +1,44 @@
 
 """Module containing algorithms for MAC list generation."""
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import logging
 import configparser
 import csv
+import functools
+import hashlib
+import json
 import time
 import tempfile
 import os
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Iterable, List, NamedTuple, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, \
+        Tuple, Union
 
 import boto3
+import numpy
 from requests import RequestException
 from sumologic import SumoLogic
 
 from .interface import InterfaceFactory
 from . import compute
+from . import macset
+from .macset import MacSet
+from .ratelimit import TokenBucket
 from . import template
 
 
 MAC_FIELDNAMES = ["mac", "macs"]
 SUMO_DEFAULT_CONFIG = ".sumo_config.ini"
+DEVICE_REGISTRY_CACHE_DIR = Path.home() / ".cache" / "frpc" / "device-registry"
+DEVICE_REGISTRY_MAX_AGE = 3600
+# device registry files are parsed in byte ranges of this size
+DEVICE_REGISTRY_CHUNK_SIZE = 16 << 20
+SUMO_CACHE_DIR = Path.home() / ".cache" / "frpc" / "sumo"
+SUMO_CACHE_TTL = 3600
+SUMO_CACHE_GRANULARITY = 300
+SUMO_CACHE_MAX_SIZE = 256 << 20
 
 S3_BUCKET_NAMES = {
     "circle1": "sc-corp-circle-vpc",
@@ -95,6 +112,134 @@ def sumo_read_config(path: str = SUMO_DEFAULT_CONFIG) -> SumoConfig:
         raise SumoConfigError(str(err)) from err
 
 
+def sumo_time_range(time_offset: float,
+                    end_time: float = None) -> Tuple[int, int]:
+    """Convert query time arguments into a range of UNIX timestamps in ms.
+
+    Arguments:
+        time_offset: if `end_time` is set, this is a UNIX timestamp,
+                     positive time offset in seconds otherwise
+        end_time: UNIX timestamp for the end of the query time range.
+
+    Throws:
+        ValueError: the range is empty.
+    """
+    time_offset = int(time_offset * 1000)
+
+    if end_time is None:
+        end_time = int(time.time() * 1000)
+        start_time = end_time - time_offset
+    else:
+        start_time = time_offset
+        end_time = int(end_time * 1000)
+
+    if start_time >= end_time:
+        raise ValueError("invalid time range")
+
+    return start_time, end_time
+
+
+class SumoCache:
+    """On-disk cache of MACs returned by Sumo queries.
+
+    Entries are keyed by the query text with normalized whitespace, the
+    query time range rounded down to `granularity` seconds and the output
+    projection, and are stored as `MacSet` files. Entries expire `ttl`
+    seconds after they were written, the oldest ones are evicted once the
+    cache outgrows `max_size` bytes.
+    """
+
+    def __init__(self, path: Path = SUMO_CACHE_DIR,
+                 ttl: float = SUMO_CACHE_TTL,
+                 granularity: int = SUMO_CACHE_GRANULARITY,
+                 max_size: int = SUMO_CACHE_MAX_SIZE):
+        """Class constructor.
+
+        Arguments:
+            path: cache directory, created on the first write.
+            ttl: entry lifetime in seconds.
+            granularity: time range rounding in seconds, 0 to disable.
+            max_size: maximum total size of the entries in bytes.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.granularity = granularity
+        self.max_size = max_size
+
+    def key(self, query: str, time_range: Tuple[int, int],
+            projection: Iterable[str]) -> str:
+        """Make an entry key.
+
+        Arguments:
+            query: Sumo query body.
+            time_range: query time range as returned by `sumo_time_range()`.
+            projection: result fields the cached value is made of.
+        """
+        step = max(int(self.granularity * 1000), 1)
+
+        return hashlib.sha256(json.dumps({
+            "query": " ".join(query.split()),
+            "time_range": [timestamp // step * step
+                           for timestamp in time_range],
+            "projection": list(projection),
+            }).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[MacSet]:
+        """Return the entry or None if it's missing or expired."""
+        path = self.path / f"{key}.npy"
+
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+
+            return MacSet.load(path, mmap=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning(f"ignoring broken sumo cache entry: {err}")
+
+            return None
+
+    def put(self, key: str, macs: MacSet):
+        """Store an entry and evict expired and old entries.
+
+        Throws:
+            OSError: failed to write the cache.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        macs.save(self.path / f"{key}.npy")
+
+        self.__evict()
+
+    def __evict(self):
+        entries = []
+
+        for path in self.path.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        now = time.time()
+        size = sum(entry[1] for entry in entries)
+
+        for mtime, entry_size, path in entries:
+            if now - mtime <= self.ttl and size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except OSError:
+                continue
+
+            size -= entry_size
+
+            logger.debug(f"evicted sumo cache entry {path.name}")
+
+
 def parse_bool(string: str):
     """Convert a string into a boolean."""
     string = string.lower()
@@ -114,15 +259,34 @@ class SumoWrapper:
     session: SumoLogic
 
     STATE_GATHERING_RESULTS = "GATHERING RESULTS"
+    STATE_CANCELLED = "CANCELLED"
+    # a force paused job has hit the result limit, but its results are final
+    STATES_DONE = ("DONE GATHERING RESULTS", "FORCE PAUSED", STATE_CANCELLED)
     LIMIT_RPM = 240 / 2  # actual is 240, but I don't want to go that far
 
+    # According to SumoLogic API we have the following rate limits:
+    #   - 240 requests per minute
+    #   - 10 concurrent API requests
+    #   - 200 active search jobs within the organizaiton
+    # the limits are per organization, so all wrappers share the bucket
+    ratelimit = TokenBucket(LIMIT_RPM / 60, burst=10)
+
+    # records and messages endpoints return at most that many items
+    PAGE_SIZE = 10000
+    # concurrent page requests of a single job, out of the 10 allowed
+    PULL_WORKERS = 4
+    # job status polling backoff bounds
+    POLL_MIN_SECS = 1
+    POLL_MAX_SECS = 16
+
     SUMOQL_LIST = None
 
-    def __init__(self, config: SumoConfig = None):
+    def __init__(self, config: SumoConfig = None, cache: SumoCache = None):
         """Class constructor.
 
         Arguments:
             config: credentials, pulled from `SUMO_DEFAULT_CONFIG` if None.
+            cache: cache for `fetch_macs()` results, don't cache if None.
 
         Throws:
             SumoConfigError: config error.
@@ -131,7 +295,7 @@ class SumoWrapper:
             config = sumo_read_config()
 
         self.session = SumoLogic(config.access_id, config.access_key)
-        self.__last_mono = time.monotonic() - 60
+        self.cache = cache
 
     def add_job(self, query: str, time_offset: float, end_time: float = None):
         """Queue a sumo query job.
@@ -142,44 +306,49 @@ class SumoWrapper:
                          positive time offset in seconds otherwise
             end_time: UNIX timestamp for the end of the query time range.
         """
-        time_offset = int(time_offset * 1000)
-
-        if end_time is None:
-            end_time = int(time.time() * 1000)
-            start_time = end_time - time_offset
-        else:
-            start_time = time_offset
-            end_time = int(end_time * 1000)
-
-        if start_time >= end_time:
-            raise ValueError("invalid time range")
+        start_time, end_time = sumo_time_range(time_offset, end_time)
 
         try:
+            self.ratelimit.acquire()
+
             return self.session.search_job(query, start_time, end_time)
         except RequestException as err:
             raise TargetingError("sumo request failed") from err
 
     def wait_job(self, job):
-        """Wait for a SumoLogic job."""
-        wait_secs = 1
-        max_wait_secs = 32
-        state = self.STATE_GATHERING_RESULTS
+        """Wait for a SumoLogic job.
+
+        The job status is polled with exponential backoff, starting at
+        `POLL_MIN_SECS` and capped at `POLL_MAX_SECS`, so short queries
+        finish fast and long ones don't eat into the request rate limit.
+
+        Throws:
+            TargetingError: the job has been cancelled.
+        """
+        wait_secs = self.POLL_MIN_SECS
+        start = time.monotonic()
+        status = None
 
-        while state == self.STATE_GATHERING_RESULTS:
+        while status is None or status["state"] not in self.STATES_DONE:
             time.sleep(wait_secs)
 
             try:
+                self.ratelimit.acquire()
                 status = self.session.search_job_status(job)
                 state = status["state"]
 
                 logger.debug(f"sumo query job {job} state = `{state}`")
 
-                if wait_secs == max_wait_secs:
-                    logger.info(f"sumo query running, state = {state}")
+                if wait_secs == self.POLL_MAX_SECS:
+                    logger.info(f"sumo query running for \
+{time.monotonic() - start:.0f}s, state = {state}")
             except RequestException:
                 logger.exception("query state update failed")
 
-            wait_secs = min(wait_secs * 2, max_wait_secs)
+            wait_secs = min(wait_secs * 2, self.POLL_MAX_SECS)
+
+        if status["state"] == self.STATE_CANCELLED:
+            raise TargetingError(f"sumo query job {job['id']} was cancelled")
 
         job["__status"] = status
 
@@ -191,6 +360,10 @@ class SumoWrapper:
             pull_messages: if `False` pull only records,
                            if `True` pull messages as well,
                            if `None` let the function decide.
+
+        Throws:
+            TargetingError: unexpected response format, or sumo returned
+                            fewer items than the job reported.
         """
         # pylint: disable=line-too-long
         # According to https://help.sumologic.com/APIs/Search-Job-API/About-the-Search-Job-API#paging-through-the-records-found-by-a-search-job # noqa: E501
@@ -229,30 +402,63 @@ record_count = {record_count}")
 
         return self.get_job_results(job, pull_messages=pull_messages)
 
-    def fetch_macs(self, *args, **kwargs) -> List[str]:
+    def fetch_macs(self, query: str, time_offset: float,
+                   end_time: float = None) -> MacSet:
         """Create a sumo query job and retrieve the results.
 
         The query must either parse or aggregate data into one of the
-        field names in `MAC_FIELDNAMES`.
+        field names in `MAC_FIELDNAMES`. Results are taken from and
+        stored into `self.cache` if it's set.
 
         Arguments:
-            See `get_job_results()` and `add_job()`.
+            See `add_job()`.
         """
-        results = self.fetch_query(*args, pull_messages=False, **kwargs)
-        results = results[1]
+        cache_key = None
 
-        if not results:
-            return []
+        if self.cache is not None:
+            cache_key = self.cache.key(
+                    query, sumo_time_range(time_offset, end_time),
+                    MAC_FIELDNAMES)
+            macs = self.cache.get(cache_key)
 
-        key = select_mac_fieldname(results[0].keys())
+            if macs is not None:
+                logger.info(f"sumo cache hit, {len(macs)} MACs")
 
-        if key is None:
-            raise TargetingError("No valid mac fieldnames in query result")
+                return macs
+
+            logger.info("sumo cache miss")
+
+        job = self.add_job(query, time_offset, end_time=end_time)
+        self.wait_job(job)
+
+        # pages are parsed as they arrive, only the mac column is converted
+        chunks = []
+
+        for page in self.iter_records(job, MAC_FIELDNAMES):
+            key = next((field for field in MAC_FIELDNAMES if field in page),
+                       None)
+
+            if key is None:
+                raise TargetingError(
+                        "No valid mac fieldnames in query result")
+
+            try:
+                chunks.append(macset.unique(macset.parse_macs(page[key])))
+            except ValueError as err:
+                raise ParseError(str(err)) from err
+
+        macs = MacSet(numpy.concatenate(chunks)) if chunks else MacSet()
 
-        return fix_macs(map(lambda result: result[key], results))
+        if cache_key is not None:
+            try:
+                self.cache.put(cache_key, macs)
+            except OSError as err:
+                logger.warning(f"failed to cache sumo results: {err}")
+
+        return macs
 
     def fetch_macs_template(self, template_name: str,
-                            *args, **kwargs) -> List[str]:
+                            *args, **kwargs) -> MacSet:
         """Create a sumo job from a template sumoql and retrieve the results.
 
         The query must either parse or aggregate data into one of the
@@ -267,60 +473,139 @@ record_count = {record_count}")
 
         return self.fetch_macs(query, *args, **kwargs)
 
-    def __limit_rate(self):
-        # According to SumoLogic API we have the following rate limits:
-        #   - 240 requests per minute
-        #   - 10 concurrent API requests
-        #   - 200 active search jobs within the organizaiton
+    def iter_records(self, job,
+                     fields: Iterable[str]) -> Iterator[Dict[str, list]]:
+        """Stream projected record columns of a finished job page by page.
+
+        Only `fields` are converted, the rest of every record is dropped,
+        so large results are never materialized as a list of records.
+
+        Arguments:
+            job: job dictionary passed to `wait_job()`.
+            fields: record field names to project, matched case-insensitively.
+                    Fields the query doesn't return are left out.
+
+        Returns:
+            Iterator over pages in offset order. Every page maps requested
+            field names to lists of their values.
 
-        mono = time.monotonic()
-        diff = mono - self.__last_mono
-        period = 60 / self.LIMIT_RPM
 
-        if period > diff:
-            delay = period - diff
+        Throws:
+            TargetingError: see `get_job_results()`.
+        """
+        fields = [field.lower() for field in fields]
+
+        def mk_reader(field_convertors, response_key):
+            names = {}
+
+            for name in field_convertors:
+                names.setdefault(name.lower(), name)
+
+            columns = {
+                    field: (names[field], field_convertors[names[field]])
+                    for field in fields
+                    if field in names
+                    }
+
+            def read(items):
+                try:
+                    return {
+                            field: [convert(item["map"][name])
+                                    for item in items]
+                            for field, (name, convert) in columns.items()
+                            }
+                except KeyError as err:
+                    raise TargetingError(f"Unexpected {response_key} format") \
+                            from err
+
+            return read
+
+        return self.__iter_pages(job, False,
+                                 job["__status"]["recordCount"], mk_reader)
+
+    def __pull(self, job, messages: bool, length, limit=PAGE_SIZE):
+        def mk_reader(field_convertors, response_key):
+            def read(items):
+                try:
+                    return [
+                            {key: field_convertors[key](value)
+                                for key, value in item["map"].items()}
+                            for item in items
+                            ]
+                except KeyError as err:
+                    raise TargetingError(f"Unexpected {response_key} format") \
+                            from err
+
+            return read
 
-            logger.debug(f"delay request for {delay:.3f}s")
-            time.sleep(delay)
+        results = []
 
-        self.__last_mono = mono
+        for page in self.__iter_pages(job, messages, length, mk_reader,
+                                      limit=limit):
+            results.extend(page)
 
-    def __pull(self, job, messages: bool, length, limit=10000):
-        # tweak this function to run several requests in parallel
+        return results
 
+    def __iter_pages(self, job, messages: bool, length, mk_reader,
+                     limit=PAGE_SIZE):
         if length <= 0:
-            return []
+            return
 
         func, response_key = [
                 (self.session.search_job_records, "records"),
                 (self.session.search_job_messages, "messages"),
                 ][int(messages)]
 
-        self.__limit_rate()
-        response = func(job, limit=limit)
-        field_convertors = self.__mk_field_convertors(response)
-        results = []
-
-        def process(response):
+        def items(response):
             try:
-                results.extend([
-                        {key: field_convertors[key](value)
-                            for key, value in item["map"].items()}
-                        for item in response[response_key]
-                        ])
-
-                return len(response[response_key])
+                return response[response_key]
             except KeyError as err:
                 raise TargetingError(f"Unexpected {response_key} format") \
                         from err
 
-        offset = process(response)
+        self.ratelimit.acquire()
+        response = func(job, limit=limit)
+        # field types come with every page, the first one is enough
+        read = mk_reader(self.__mk_field_convertors(response), response_key)
 
-        while offset < length:
-            response = func(job, limit=limit, offset=offset)
-            offset += process(response)
+        def fetch(offset, end):
+            # a page may come back short, fetch the rest of it then
+            pages = []
 
-        return results
+            while offset < end:
+                self.ratelimit.acquire()
+                page = items(func(job, limit=end - offset, offset=offset))
+
+                # the job reported more items than it returns
+                if not page:
+                    raise TargetingError(f"sumo returned no {response_key} \
+at offset {offset} out of {length}")
+
+                pages.append(read(page))
+                offset += len(page)
+
+            return pages
+
+        page = items(response)
+        offset = len(page)
+
+        yield read(page)
+
+        if offset < min(limit, length):
+            yield from fetch(offset, min(limit, length))
+
+        offsets = range(limit, length, limit)
+        ends = [min(offset + limit, length) for offset in offsets]
+
+        if len(offsets) > 1:
+            logger.debug(f"pulling {len(offsets)} more pages of {length} \
+{response_key} in parallel")
+
+        with ThreadPoolExecutor(min(self.PULL_WORKERS, len(offsets) or 1),
+                                thread_name_prefix="sumo-pull") as pool:
+            # pages are yielded in offset order
+            for pages in pool.map(fetch, offsets, ends):
+                yield from pages
 
     @staticmethod
     def __mk_field_convertors(response):
@@ -362,21 +647,27 @@ SumoWrapper.SUMOQL_LIST = template.list_templates(
         SumoWrapper.get_sumoql_path())
 
 
-def device_registry_select(device_registry: List[str], macs: List[str]):
-    """Select a list of macs common between `device_registry` and `macs`."""
-    return list(set(device_registry) & set(macs))
+def device_registry_select(device_registry: MacSet,
+                           macs: Union[MacSet, Iterable[str]]) -> MacSet:
+    """Select macs common between `device_registry` and `macs`.
+
+    Throws:
+        ParseError: one of the `macs` strings has invalid format.
+    """
+    return device_registry & fix_macs(macs)
 
 
 class DeviceRegistryTargeting:
     """Implementations for selecting device lists from sumo and boson."""
 
-    def __init__(self, device_registry: List[str],
+    def __init__(self, device_registry: MacSet,
                  sumo_config: SumoConfig = None,
-                 boson_factory: InterfaceFactory = None):
+                 boson_factory: InterfaceFactory = None,
+                 sumo_cache: SumoCache = None):
         """Construct a targeting class.
 
         Arguments:
-            device_registry: a list of MACs. Output from every funtion of
+            device_registry: a set of MACs. Output from every funtion of
                              this class will be filtered to macs in this list.
             sumo_config: SumoConfig to use when creating `SumoWrapper`.
                          Leave as `None` if you want `SumoWrapper` to load
@@ -385,18 +676,19 @@ class DeviceRegistryTargeting:
                            of pumps w/o boson connection. This argument is
                            required if you want `self.fetch_no_boson()`
                            to work properly.
+            sumo_cache: cache for sumo query results.
         """
         self.device_registry = device_registry
         self.time_range = (86400, None)
-        self._sumo = SumoWrapper(config=sumo_config)
+        self._sumo = SumoWrapper(config=sumo_config, cache=sumo_cache)
         self.boson_factory = boson_factory
 
-    def select(self, macs: List[str]) -> List[str]:
+    def select(self, macs: Union[MacSet, Iterable[str]]) -> MacSet:
         """Select common macs in `self.device_registry` and `macs`."""
         return device_registry_select(self.device_registry, macs)
 
     def fetch_sumo(self, template_name: str,
-                   time_range: Tuple[float, float] = None) -> List[str]:
+                   time_range: Tuple[float, float] = None) -> MacSet:
         """Select macs from sumo query common with device registry.
 
         Arguments:
@@ -421,17 +713,18 @@ MACs, out of which {len(macs)} ({perc:.2f}%) are in device registry")
 
         return macs
 
-    def fetch_no_boson(self) -> List[str]:
+    def fetch_no_boson(self) -> MacSet:
         """Select macs w/o boson connection common with device registry."""
         if self.boson_factory is None:
             raise RuntimeError("`boson_factory` is None")
 
         logger.info("fetching macs connected to boson")
 
-        with self.boson_factory(self.device_registry) as interface:
+        with self.boson_factory(self.device_registry.to_strings()) \
+                as interface:
             online_macs = interface.get_online()
 
-        macs = list(set(self.device_registry) - set(online_macs))
+        macs = self.device_registry - fix_macs(online_macs)
         current = len(macs)
         perc = compute.perc(current, len(self.device_registry))
 
@@ -477,18 +770,16 @@ def fix_mac(mac: str):
     return mac.lower()
 
 
-def fix_macs(iterable: Iterable[str]):
+def fix_macs(iterable: Union[MacSet, Iterable[str]]) -> MacSet:
     """Fix duplicate macs in an iterable of strings.
 
     Throws:
         ParseError: one of the macs has invalid format.
     """
-    macs = set()
-
-    for mac in iterable:
-        macs.add(fix_mac(mac))
-
-    return list(macs)
+    try:
+        return MacSet.coerce(iterable)
+    except ValueError as err:
+        raise ParseError(str(err)) from err
 
 
 def generate_s3_bucket_prefix(environment: str) -> str:
@@ -525,56 +816,311 @@ defined for {environment} environment yet")
     return name
 
 
-def load_dg_device_registry(path: Path) -> List[str]:
+def _parse_dg_lines(data: bytes, low: int, high: int) -> numpy.ndarray:
+    """Parse MACs of device registry lines, keep the ones in [low, high)."""
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(buf == ord("\n"))
+    starts = numpy.concatenate(([0], newlines + 1))
+    ends = numpy.concatenate((newlines, [len(buf)]))
+    # most lines start with a MAC followed by a blank or the line end,
+    # these are parsed in one go, the rest line by line
+    padded = numpy.concatenate((
+        buf, numpy.full(macset.MAC_LENGTH + 1, ord("\n"), dtype=numpy.uint8)))
+    after = padded[starts + macset.MAC_LENGTH]
+    fast = (ends - starts >= macset.MAC_LENGTH) & \
+        numpy.isin(after, numpy.frombuffer(b" \t\r\v\f\n", numpy.uint8))
+    codes = padded[starts[fast, None] + numpy.arange(macset.MAC_LENGTH)]
+    tokens = []
+
+    for start, end in zip(starts[~fast], ends[~fast]):
+        fields = data[start:end].split()
+
+        if fields:
+            tokens.append(fields[0].decode(errors="replace"))
+
+    values = numpy.concatenate((macset.parse_ascii(codes),
+                                macset.parse_macs(tokens)))
+
+    return macset.unique(values[(values >= low) & (values < high)])
+
+
+def _parse_dg_range(path: str, start: int, end: int, low: int,
+                    high: int) -> numpy.ndarray:
+    """Parse lines of a device registry file starting in [start, end)."""
+    with open(path, "rb") as dr_file:
+        dr_file.seek(start - 1)
+
+        # a partial first line belongs to the previous range
+        if dr_file.read(1) != b"\n":
+            dr_file.readline()
+
+        data = dr_file.read(max(end - dr_file.tell(), 0))
+
+        # and a partial last line belongs to this one
+        if data and not data.endswith(b"\n"):
+            data += dr_file.readline()
+
+    return _parse_dg_lines(data, low, high)
+
+
+def iter_dg_device_registry(path: Path, prefix: str = "",
+                            processes: int = None,
+                            chunk_size: int = DEVICE_REGISTRY_CHUNK_SIZE
+                            ) -> Iterator[numpy.ndarray]:
+    """Parse a device registry file in parallel, chunk by chunk.
+
+    Arguments:
+        path: device registry file path.
+        prefix: hex prefix, only MACs that start with it are returned.
+        processes: number of worker processes, CPU count if None.
+        chunk_size: approximate size of a chunk in bytes.
+
+    Returns:
+        Iterator over sorted arrays of unique MACs of every chunk,
+        in file order. The same MAC may appear in several chunks.
+
+    Throws:
+        OSError: if there was an error opening the file.
+        ParseError: if there was unexpected parsing error.
+        ValueError: `prefix` isn't a hex string.
+    """
+    low, high = macset.prefix_range(prefix)
+
+    with path.open("rb") as dr_file:
+        header = dr_file.readline()
+
+    if not header.startswith(b"macAddress"):
+        raise ParseError("expected first line to contain a header")
+
+    size = path.stat().st_size
+    starts = list(range(len(header), size, chunk_size))
+    ends = [min(start + chunk_size, size) for start in starts]
+    parse = functools.partial(_parse_dg_range, str(path), low=low, high=high)
+
+    try:
+        if len(starts) <= 1 or processes == 1:
+            yield from map(parse, starts, ends)
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                yield from pool.map(parse, starts, ends)
+    except ValueError as err:
+        raise ParseError(str(err)) from err
+
+
+def load_dg_device_registry(path: Path, prefix: str = "",
+                            processes: int = None) -> MacSet:
     """Load a list of devices from a device registry file.
 
+    Arguments:
+        See `iter_dg_device_registry()`.
+
     Throws:
         OSError: if there was an error opening the file.
         ParseError: if there was unexpected parsing error.
     """
-    with path.open() as dr_file:
-        line = dr_file.readline()
+    chunks = list(iter_dg_device_registry(path, prefix, processes))
+
+    if not chunks:
+        return MacSet()
+
+    return MacSet(numpy.concatenate(chunks))
+
+
+class DeviceRegistryCache:
+    """Local cache of device registries downloaded from S3.
+
+    Registries are stored parsed, as `MacSet` files keyed by S3 bucket and
+    key. A cached registry is valid while the S3 object keeps the same ETag
+    and LastModified, and is considered fresh for `max_age` seconds after
+    it was last validated.
+    """
+
+    def __init__(self, path: Path = DEVICE_REGISTRY_CACHE_DIR,
+                 max_age: float = DEVICE_REGISTRY_MAX_AGE):
+        """Class constructor.
+
+        Arguments:
+            path: cache directory, created on the first write.
+            max_age: how long a validated registry stays fresh, in seconds.
+        """
+        self.path = path
+        self.max_age = max_age
+
+    def fresh(self, env: str) -> Optional[MacSet]:
+        """Return the latest registry of `env` if it's still fresh."""
+        meta = self.__read_meta(env)
+
+        if meta is None or time.time() - meta["validated_at"] > self.max_age:
+            return None
+
+        return self.__load(meta)
+
+    def get(self, env: str, bucket: str, s3_object: Dict) -> Optional[MacSet]:
+        """Return a cached copy of `s3_object` if it's still valid.
+
+        Arguments:
+            env: environment name.
+            bucket: S3 bucket name.
+            s3_object: object description from `list_objects_v2`.
+        """
+        meta = self.__read_meta(env)
+
+        if meta is None or meta["source"] != self.__source(bucket, s3_object):
+            return None
+
+        device_registry = self.__load(meta)
+
+        if device_registry is not None:
+            meta["validated_at"] = time.time()
+            self.__write_meta(env, meta)
+
+        return device_registry
+
+    def put(self, env: str, bucket: str, s3_object: Dict,
+            device_registry: MacSet):
+        """Store `device_registry` parsed from `s3_object`.
+
+        The previous registry of `env` is removed.
+
+        Throws:
+            OSError: failed to write the cache.
+        """
+        source = self.__source(bucket, s3_object)
+        name = hashlib.sha256(f"{bucket}/{s3_object['Key']}".encode()) \
+            .hexdigest()[:32]
+        old_meta = self.__read_meta(env)
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        device_registry.save(self.path / f"{name}.npy")
+
+        self.__write_meta(env, {
+            "source": source,
+            "file": f"{name}.npy",
+            "sha256": device_registry.digest(),
+            "validated_at": time.time(),
+            })
+
+        if old_meta is not None and old_meta["file"] != f"{name}.npy":
+            try:
+                (self.path / old_meta["file"]).unlink()
+            except OSError:
+                pass
 
-        if not line.startswith("macAddress"):
-            raise ParseError("expected first line to contain a header")
+    @staticmethod
+    def __source(bucket: str, s3_object: Dict) -> Dict:
+        return {
+                "bucket": bucket,
+                "key": s3_object["Key"],
+                "etag": s3_object["ETag"],
+                "last_modified": s3_object["LastModified"].isoformat(),
+                }
+
+    def __meta_path(self, env: str) -> Path:
+        return self.path / f"latest-{env}.json"
+
+    def __read_meta(self, env: str) -> Optional[Dict]:
+        try:
+            with self.__meta_path(env).open() as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logger.warning(f"ignoring broken device registry cache: {err}")
+
+            return None
+
+    def __write_meta(self, env: str, meta: Dict):
+        path = self.__meta_path(env)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}")
+
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, path)
+
+    def __load(self, meta: Dict) -> Optional[MacSet]:
+        path = self.path / meta["file"]
+
+        try:
+            device_registry = MacSet.load(path)
+        except (OSError, ValueError) as err:
+            logger.warning(f"ignoring broken device registry cache: {err}")
+
+            return None
 
-        return fix_macs(line.lstrip().split()[0] for line in dr_file)
+        if device_registry.digest() != meta["sha256"]:
+            logger.warning(f"ignoring corrupted device registry cache {path}")
 
+            return None
 
-def load_latest_device_registry(env: str) -> List[str]:
+        return device_registry
+
+
+def load_latest_device_registry(env: str,
+                                cache: DeviceRegistryCache = None,
+                                offline: bool = False,
+                                prefix: str = "") -> MacSet:
     """Load a list of devices from an S3 device registry.
 
     Arguments:
         env: environment name.
+        cache: local cache to reuse registries from, don't cache if None.
+               The whole registry is cached regardless of `prefix`.
+        offline: use a fresh cached registry without checking S3.
+        prefix: hex prefix, only MACs that start with it are returned.
 
     Throws:
         MissingDeviceRegistryError: if there is no DR file for the past hour.
         botocore.exceptions.ClientError: if there was an error retrieving file
                                          from S3.
     """
+    if offline and cache is not None:
+        device_registry = cache.fresh(env)
+
+        if device_registry is not None:
+            logger.info(f"Using cached {env} device registry without \
+checking S3")
+
+            return device_registry.with_prefix(prefix)
+
+        logger.info(f"no fresh cached {env} device registry, checking S3")
+
     s3_client = boto3.client("s3")
 
     bucket = get_s3_bucket_name(env)
-    prefix = generate_s3_bucket_prefix(env)
+    s3_prefix = generate_s3_bucket_prefix(env)
 
-    file_list = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    file_list = s3_client.list_objects_v2(Bucket=bucket, Prefix=s3_prefix)
 
     if "Contents" not in file_list:
         raise MissingDeviceRegistryError(f"No recent device registry file for \
-{env} in s3://{bucket}/prefix")
+{env} in s3://{bucket}/{s3_prefix}")
 
     latest = max(file_list["Contents"], key=lambda x: x["LastModified"])
 
     logger.info(f"Using {latest['Key']} device registry")
 
+    if cache is not None:
+        device_registry = cache.get(env, bucket, latest)
+
+        if device_registry is not None:
+            logger.info("device registry cache hit")
+
+            return device_registry.with_prefix(prefix)
+
     with tempfile.NamedTemporaryFile(mode="w+b", buffering=0) as tmp_fp:
         s3_client.download_fileobj(bucket, latest["Key"], tmp_fp)
-        device_registry = load_dg_device_registry(Path(tmp_fp.name))
+        device_registry = load_dg_device_registry(
+                Path(tmp_fp.name), prefix="" if cache is not None else prefix)
+
+    if cache is not None:
+        try:
+            cache.put(env, bucket, latest, device_registry)
+        except OSError as err:
+            logger.warning(f"failed to cache device registry: {err}")
 
-    return device_registry
+    return device_registry.with_prefix(prefix)
 
 
-def load_csv(path: Path) -> List[str]:
+def load_csv(path: Path) -> MacSet:
     """Load a list of devices from a CSV file.
 
     The file may be produces by SUMO or created manually.
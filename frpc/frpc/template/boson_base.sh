@@ -23,6 +23,7 @@ function error() {
 
 
 salt=s`date +%s`
+cstat_dir=${CSTAT_DIR:-/var/run/cstat}
 
 
 function get_boson_line() {
@@ -32,7 +33,7 @@ function get_boson_line() {
     [[ -z $ssh_command ]] && error "ssh_command expected"
     [[ -z $mac ]] && error "mac expected"
 
-    cstat=/var/run/cstat/`tail -c 3 <<< $mac`/$mac
+    cstat=$cstat_dir/`tail -c 3 <<< $mac`/$mac
 
     if [[ -f $cstat ]]; then
         bash -c "`cat $(which boson)`" "echo $ssh_command$salt" $mac \
@@ -143,13 +144,38 @@ function boson_init() {
 }
 
 
+function process_mac() {
+    local mac=$1
+
+    mkdir -p $results_dir/$mac
+    # {{{iter_body}}}
+}
+
+
+function wait_for_slot() {
+    while (( `jobs -rp | wc -l` >= parallelism )); do
+        sleep 0.2
+    done
+}
+
+
 macs="{{{macs}}}"
 # {{{macs}}}
+parallelism=1
+# {{{parallelism}}}
 stats_processed=0
 boson_init
 for mac in $connected_macs; do
-    mkdir -p $results_dir/$mac
-    # {{{iter_body}}}
-    (( stats_processed += 1 ))
-    log_info "processed $stats_processed out of $stats_connected"
+    if (( parallelism > 1 )); then
+        # `wait -n` needs bash 4.3, poll the running jobs instead
+        wait_for_slot
+        process_mac $mac &
+        (( stats_processed += 1 ))
+        log_info "started $stats_processed out of $stats_connected"
+    else
+        process_mac $mac
+        (( stats_processed += 1 ))
+        log_info "processed $stats_processed out of $stats_connected"
+    fi
 done
+wait
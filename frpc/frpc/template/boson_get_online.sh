@@ -9,7 +9,7 @@ function list_suffixes() {
     for i in `seq $offset $step $(( ${#suffixes[@]} - 1 ))`; do
         suffix=${suffixes[$i]}
         1>&2 echo "suffix=$suffix"
-        find /var/run/cstat/$suffix -type f -name "????????????" -printf "%f\n"
+        find $cstat_dir/$suffix -type f -name "????????????" -printf "%f\n"
     done
 }
 
@@ -20,6 +20,7 @@ function get_filename() {
 }
 
 
+cstat_dir=${CSTAT_DIR:-/var/run/cstat}
 filename_magic=`head /dev/urandom | tr -cd [:alnum:] | head -c 8`
 # {{{suffixes}}}
 
@@ -0,0 +1,164 @@
+"""Content-addressed staging of uploaded files."""
+
+import atexit
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, Iterable, NamedTuple, Set, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+# read/compress block size
+BLOCK_SIZE = 1 << 20
+
+
+class StagedUpload(NamedTuple):
+    """A local file staged for upload."""
+
+    digest: str
+    local_path: str
+    size: int
+    compressed_path: str
+
+
+class UploadCache:
+    """Thread-safe, content-addressed cache of files to upload.
+
+    Every file is hashed and gzip-compressed once per process, no matter
+    how many partitions upload it. The cache also remembers which digests
+    every remote host already has, so a file is transferred to a host at
+    most once.
+    """
+
+    def __init__(self, compresslevel: int = 6):
+        """Class constructor.
+
+        Arguments:
+            compresslevel: gzip compression level of staged files.
+        """
+        self.compresslevel = compresslevel
+
+        self.__lock = threading.Lock()
+        self.__staged: Dict[Tuple[str, int, int], StagedUpload] = {}
+        self.__stage_locks: Dict[str, threading.Lock] = {}
+        self.__host_locks: Dict[str, threading.Lock] = {}
+        self.__remote: Dict[str, Set[str]] = {}
+        self.__staging_dir = None
+
+    def stage(self, local_path: str) -> StagedUpload:
+        """Hash and compress `local_path`, unless it's been staged already.
+
+        A file is staged again if its size or modification time changes.
+
+        Throws:
+            OSError: failed to read `local_path`.
+        """
+        real_path = os.path.realpath(local_path)
+        stat = os.stat(real_path)
+        key = (real_path, stat.st_mtime_ns, stat.st_size)
+
+        with self.__lock:
+            staged = self.__staged.get(key)
+            lock = self.__stage_locks.setdefault(real_path, threading.Lock())
+
+        if staged is not None:
+            return staged
+
+        with lock:
+            with self.__lock:
+                staged = self.__staged.get(key)
+
+            if staged is None:
+                staged = self.__stage(local_path, real_path, stat.st_size)
+
+                with self.__lock:
+                    self.__staged[key] = staged
+
+        return staged
+
+    def ensure_remote(self, host: str, staged: Iterable[StagedUpload],
+                      list_remote: Callable[[], Iterable[str]],
+                      transfer: Callable[[StagedUpload], None]):
+        """Make sure `host` has all `staged` files in its cache directory.
+
+        Concurrent callers for the same host wait for each other, so every
+        file is transferred once.
+
+        Arguments:
+            host: remote host name.
+            staged: files that have to be present on `host`.
+            list_remote: callable that returns digests present on `host`,
+                         called once per host.
+            transfer: callable that transfers a file to `host`.
+        """
+        with self.__lock:
+            lock = self.__host_locks.setdefault(host, threading.Lock())
+
+        with lock:
+            known = self.__remote.get(host)
+
+            if known is None:
+                known = set(list_remote())
+                self.__remote[host] = known
+
+                logger.debug(f"{host} has {len(known)} cached uploads")
+
+            for item in staged:
+                if item.digest in known:
+                    continue
+
+                transfer(item)
+                known.add(item.digest)
+
+                logger.debug(f"uploaded `{item.local_path}` \
+({item.size} bytes) to {host} as {item.digest}")
+
+    def close(self):
+        """Remove staged files."""
+        with self.__lock:
+            staging_dir = self.__staging_dir
+            self.__staging_dir = None
+            self.__staged = {}
+
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def __stage(self, local_path: str, real_path: str,
+                size: int) -> StagedUpload:
+        with self.__lock:
+            if self.__staging_dir is None:
+                self.__staging_dir = tempfile.mkdtemp(prefix="frpc-uploads-")
+                atexit.register(self.close)
+
+            staging_dir = self.__staging_dir
+
+        sha256 = hashlib.sha256()
+
+        with open(real_path, "rb") as fileobj:
+            for block in iter(lambda: fileobj.read(BLOCK_SIZE), b""):
+                sha256.update(block)
+
+        digest = sha256.hexdigest()
+        compressed_path = os.path.join(staging_dir, f"{digest}.gz")
+
+        # identical contents under another name are compressed only once
+        if not os.path.exists(compressed_path):
+            tmp_path = f"{compressed_path}.{threading.get_ident()}"
+
+            with open(real_path, "rb") as src, \
+                    gzip.open(tmp_path, "wb",
+                              compresslevel=self.compresslevel) as dst:
+                shutil.copyfileobj(src, dst, BLOCK_SIZE)
+
+            os.replace(tmp_path, compressed_path)
+
+        logger.debug(f"staged `{local_path}` as {digest}")
+
+        return StagedUpload(digest=digest, local_path=local_path, size=size,
+                            compressed_path=compressed_path)